@@ -0,0 +1,45 @@
+import asyncio
+
+import moltin_async
+from moltin_api import parse_cart
+
+
+async def load_product_image(access_token, product):
+    return await moltin_async.get_image(access_token, product)
+
+
+async def load_stock_and_image(access_token, product):
+    # A failed stock read can still fall back to the snapshot, so its error is returned instead of raised
+    product_quantity, image = await asyncio.gather(
+        moltin_async.get_product_quantity(access_token, product.id),
+        moltin_async.get_image(access_token, product),
+        return_exceptions=True,
+    )
+    if isinstance(image, BaseException):
+        raise image
+    return product_quantity, image
+
+
+async def purchase_product(access_token, product_id, product_quantity, chat_id):
+    cart_items = await moltin_async.add_to_cart(access_token, product_id, product_quantity, chat_id)
+    return parse_cart(cart_items)
+
+
+async def load_cart(access_token, chat_id):
+    cart_items = await moltin_async.get_cart_items(access_token, chat_id)
+    return parse_cart(cart_items)
+
+
+async def remove_product(access_token, cart_item_id, chat_id):
+    cart_items = await moltin_async.delete_from_cart(access_token, cart_item_id, chat_id)
+    return parse_cart(cart_items)
+
+
+async def save_customer(access_token, user_name, phone_number, email, customer_id=None):
+    # An earlier attempt of the order may have created the customer and failed afterwards,
+    # a second create would make a duplicate or fail on the taken email
+    if not customer_id:
+        customer_id = await moltin_async.find_customer_id(access_token, email)
+    if customer_id:
+        return await moltin_async.update_customer(access_token, user_name, phone_number, email, customer_id)
+    return await moltin_async.create_customer(access_token, user_name, phone_number, email)
@@ -0,0 +1,279 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from uuid import uuid4
+
+PRICE_BOOK_ID = 'fish-price-book'
+
+# 1x1 transparent PNG
+IMAGE_CONTENT = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082'
+)
+
+
+class FakeMoltinState:
+
+    def __init__(self, products_count, stock):
+        self.lock = threading.Lock()
+        self.products = [
+            {
+                'id': f'product-{number}',
+                'sku': f'sku-{number}',
+                'name': f'Рыба {number}',
+                'price': 1000 + number,
+            }
+            for number in range(products_count)
+        ]
+        self.products_by_id = {product['id']: product for product in self.products}
+        self.inventories = {product['id']: stock for product in self.products}
+        self.carts = {}
+        self.customers = {}
+
+
+class FakeMoltinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = (
+        ('POST', r'/oauth/access_token', 'create_token'),
+        ('GET', r'/pcm/products', 'list_products'),
+        ('GET', r'/pcm/pricebooks/?', 'list_price_books'),
+        ('GET', r'/pcm/pricebooks/(?P<price_book_id>[^/]+)', 'get_price_book'),
+        ('GET', r'/v2/inventories/(?P<product_id>[^/]+)', 'get_inventory'),
+        ('POST', r'/v2/inventories/(?P<product_id>[^/]+)/transactions', 'create_transaction'),
+        ('GET', r'/v2/carts/(?P<cart_id>[^/]+)/items', 'get_cart'),
+        ('POST', r'/v2/carts/(?P<cart_id>[^/]+)/items', 'add_cart_item'),
+        ('DELETE', r'/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', 'delete_cart_item'),
+        ('GET', r'/v2/customers', 'list_customers'),
+        ('POST', r'/v2/customers', 'create_customer'),
+        ('PUT', r'/v2/customers/(?P<customer_id>[^/]+)', 'update_customer'),
+        ('GET', r'/images/(?P<product_id>[^/]+)\.png', 'get_image'),
+    )
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        content_length = int(self.headers.get('Content-Length', 0))
+        self.body = self.rfile.read(content_length) if content_length else b''
+
+        for route_method, pattern, handler_name in self.routes:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                with self.state.lock:
+                    self.server.requests[handler_name] += 1
+                time.sleep(self.server.latency)
+                getattr(self, handler_name)(**match.groupdict())
+                return
+        self.send_json({'errors': [{'title': 'Not Found'}]}, status=404)
+
+    def send_json(self, content, status=200):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        return json.loads(self.body)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def create_token(self):
+        self.send_json({
+            'access_token': uuid4().hex,
+            'expires': int(time.time()) + 3600,
+        })
+
+    def list_products(self):
+        page_limit = int(self.query.get('page[limit]', 100))
+        page_offset = int(self.query.get('page[offset]', 0))
+        page = self.state.products[page_offset:page_offset + page_limit]
+        self.send_json({
+            'data': [
+                {
+                    'id': product['id'],
+                    'type': 'product',
+                    'attributes': {
+                        'name': product['name'],
+                        'description': f'Свежая {product["name"].lower()}',
+                        'sku': product['sku'],
+                        'slug': product['sku'],
+                    },
+                    'relationships': {
+                        'main_image': {'data': {'id': f'image-{product["id"]}', 'type': 'file'}},
+                    },
+                }
+                for product in page
+            ],
+            'included': {
+                'main_images': [
+                    {
+                        'id': f'image-{product["id"]}',
+                        'type': 'file',
+                        'mime_type': 'image/png',
+                        'link': {'href': f'{self.server.url}/images/{product["id"]}.png'},
+                    }
+                    for product in reversed(page)
+                ],
+            },
+            'meta': {'results': {'total': len(self.state.products)}},
+        })
+
+    def list_price_books(self):
+        self.send_json({
+            'data': [
+                {'id': 'other-price-book', 'attributes': {'name': 'Other price book'}},
+                {'id': PRICE_BOOK_ID, 'attributes': {'name': 'Fish price book'}},
+            ],
+        })
+
+    def get_price_book(self, price_book_id):
+        self.send_json({
+            'data': {'id': price_book_id, 'attributes': {'name': 'Fish price book'}},
+            'included': [
+                {
+                    'type': 'product-price',
+                    'attributes': {
+                        'sku': product['sku'],
+                        'currencies': {'USD': {'amount': product['price'], 'includes_tax': False}},
+                    },
+                }
+                for product in self.state.products
+            ],
+        })
+
+    def get_inventory(self, product_id):
+        with self.state.lock:
+            available = self.state.inventories.get(product_id)
+        if available is None:
+            self.send_json({'errors': [{'title': 'Not Found'}]}, status=404)
+            return
+        self.send_json({'data': {'id': product_id, 'available': available}})
+
+    def create_transaction(self, product_id):
+        transaction = self.read_json()['data']
+        quantity = transaction['quantity']
+        with self.state.lock:
+            if transaction['action'] == 'allocate':
+                self.state.inventories[product_id] -= quantity
+            elif transaction['action'] == 'deallocate':
+                self.state.inventories[product_id] += quantity
+        self.send_json({'data': {'id': uuid4().hex, 'type': 'stock-transaction', **transaction}})
+
+    def serialize_cart(self, cart_id):
+        return {
+            'data': [
+                {
+                    'id': item_id,
+                    'type': 'cart_item',
+                    'product_id': item['product_id'],
+                    'name': self.state.products_by_id[item['product_id']]['name'],
+                    'quantity': item['quantity'],
+                    'meta': {
+                        'display_price': {
+                            'without_discount': {
+                                'value': {
+                                    'amount': self.state.products_by_id[item['product_id']]['price'] * item['quantity'],
+                                },
+                            },
+                        },
+                    },
+                }
+                for item_id, item in self.state.carts.get(cart_id, {}).items()
+            ],
+        }
+
+    def get_cart(self, cart_id):
+        with self.state.lock:
+            cart = self.serialize_cart(cart_id)
+        self.send_json(cart)
+
+    def add_cart_item(self, cart_id):
+        cart_item = self.read_json()['data']
+        with self.state.lock:
+            cart = self.state.carts.setdefault(cart_id, {})
+            for item in cart.values():
+                if item['product_id'] == cart_item['id']:
+                    item['quantity'] += cart_item['quantity']
+                    break
+            else:
+                cart[uuid4().hex] = {'product_id': cart_item['id'], 'quantity': cart_item['quantity']}
+            serialized_cart = self.serialize_cart(cart_id)
+        self.send_json(serialized_cart, status=201)
+
+    def delete_cart_item(self, cart_id, item_id):
+        with self.state.lock:
+            self.state.carts.get(cart_id, {}).pop(item_id, None)
+            serialized_cart = self.serialize_cart(cart_id)
+        self.send_json(serialized_cart)
+
+    def list_customers(self):
+        email = self.query.get('filter', '')[len('eq(email,'):-1]
+        with self.state.lock:
+            customers = [
+                {'id': customer_id, **customer} for customer_id, customer in self.state.customers.items()
+                if customer['email'] == email
+            ]
+        self.send_json({'data': customers})
+
+    def create_customer(self):
+        customer = self.read_json()['data']
+        customer_id = uuid4().hex
+        with self.state.lock:
+            self.state.customers[customer_id] = customer
+        self.send_json({'data': {'id': customer_id, **customer}}, status=201)
+
+    def update_customer(self, customer_id):
+        customer = self.read_json()['data']
+        with self.state.lock:
+            self.state.customers[customer_id] = customer
+        self.send_json({'data': {'id': customer_id, **customer}})
+
+    def get_image(self, product_id):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(IMAGE_CONTENT)))
+        self.end_headers()
+        self.wfile.write(IMAGE_CONTENT)
+
+
+class FakeMoltinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, products_count=20, stock=100000, latency=0.05, host='127.0.0.1', port=0):
+        super().__init__((host, port), FakeMoltinHandler)
+        self.state = FakeMoltinState(products_count, stock)
+        self.latency = latency
+        self.requests = Counter()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='fake-moltin', daemon=True)
+        thread.start()
+        return thread
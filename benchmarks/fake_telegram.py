@@ -0,0 +1,114 @@
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {
+    'id': 1,
+    'is_bot': True,
+    'first_name': 'Fish shop',
+    'username': 'fish_shop_bot',
+}
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def read_params(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(content_length) if content_length else b''
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('multipart/form-data'):
+            form = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            params = {}
+            for part in form.get_payload():
+                content = part.get_payload(decode=True)
+                if part.get_filename() is None:
+                    content = content.decode()
+                params[part.get_param('name', header='content-disposition')] = content
+            return params
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def dispatch(self):
+        match = re.fullmatch(r'/bot[^/]+/(?P<method>\w+)', self.path)
+        if not match:
+            self.send_json({'ok': False, 'error_code': 404, 'description': 'Not Found'}, status=404)
+            return
+        method = match['method']
+        params = self.read_params()
+        with self.server.lock:
+            self.server.requests[method] += 1
+        time.sleep(self.server.latency)
+        self.send_json({'ok': True, 'result': self.server.make_result(method, params)})
+
+    def send_json(self, content, status=200):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.02, host='127.0.0.1', port=0):
+        super().__init__((host, port), FakeTelegramHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def make_message(self, params):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id')), 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if 'photo' in params or 'media' in params:
+            message['photo'] = [{
+                'file_id': f'file-{next(self._file_ids)}',
+                'file_unique_id': f'unique-{next(self._file_ids)}',
+                'width': 1,
+                'height': 1,
+            }]
+            message['caption'] = params.get('caption', '')
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+    def make_result(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageMedia', 'editMessageCaption'):
+            return self.make_message(params)
+        return True
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='fake-telegram', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,226 @@
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from queue import Queue
+
+import redis
+import telegram
+from environs import Env
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from benchmarks.fake_moltin import FakeMoltinServer
+from benchmarks.fake_telegram import BOT_USER, FakeTelegramServer
+import moltin_async
+from moltin_api import ApiClient, configure_client
+from telegram_bot import setup_dispatcher
+
+BOT_TOKEN = '123456:load-test'
+ADMIN_CHAT_ID = 1
+
+current_step = threading.local()
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+class SimulatedUser:
+
+    update_ids = itertools.count(1)
+
+    def __init__(self, user_id, dispatcher, catalog_ids, timings):
+        self.user_id = user_id
+        self.dispatcher = dispatcher
+        self.catalog_ids = catalog_ids
+        self.timings = timings
+        self.registered = False
+        self.user = {
+            'id': user_id,
+            'is_bot': False,
+            'first_name': 'Load',
+            'last_name': f'User {user_id}',
+        }
+        self.chat = {'id': user_id, 'type': 'private'}
+
+    def make_message(self, **fields):
+        return {
+            'message_id': next(self.update_ids),
+            'date': int(time.time()),
+            'chat': self.chat,
+            'from': self.user,
+            **fields,
+        }
+
+    def send_update(self, step, update_content):
+        update = Update.de_json({'update_id': next(self.update_ids), **update_content}, self.dispatcher.bot)
+        current_step.name = step
+        current_step.failed = False
+        started_at = time.perf_counter()
+        self.dispatcher.process_update(update)
+        self.timings[step].append(time.perf_counter() - started_at)
+        return not current_step.failed
+
+    def send_command(self, step, command):
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return self.send_update(step, {'message': self.make_message(text=command, entities=entities)})
+
+    def send_text(self, step, text):
+        return self.send_update(step, {'message': self.make_message(text=text)})
+
+    def send_contact(self, step):
+        contact = {'phone_number': f'+7900{self.user_id:07d}', 'first_name': 'Load', 'user_id': self.user_id}
+        return self.send_update(step, {'message': self.make_message(contact=contact)})
+
+    def press_button(self, step, data):
+        bot_message = {**self.make_message(text='...'), 'from': BOT_USER}
+        callback_query = {
+            'id': str(next(self.update_ids)),
+            'from': self.user,
+            'chat_instance': str(self.user_id),
+            'data': data,
+            'message': bot_message,
+        }
+        return self.send_update(step, {'callback_query': callback_query})
+
+    def walk(self):
+        product_id = random.choice(self.catalog_ids)
+        self.send_command('start', '/start')
+        self.press_button('product', product_id)
+        self.press_button('purchase', f'1 {product_id}')
+        self.press_button('back_to_menu', 'back_to_menu')
+        self.press_button('cart', 'go_to_cart')
+        self.press_button('checkout', 'go_to_payment')
+        if self.registered:
+            self.press_button('order', 'arrange_order')
+            return
+        self.press_button('name', 'name_accepted')
+        self.send_text('email', f'load.user.{self.user_id}@example.com')
+        self.registered = self.send_contact('contact')
+
+
+def run_load(dispatcher, users_count, iterations):
+    catalog_ids = [product.id for product in dispatcher.bot_data['catalog']]
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+
+    def count_error(update, context):
+        current_step.failed = True
+        errors[getattr(current_step, 'name', 'unknown')] += 1
+
+    dispatcher.add_error_handler(count_error)
+    first_user_id = random.randint(10 ** 8, 10 ** 9)
+
+    def run_user(user_id):
+        user = SimulatedUser(user_id, dispatcher, catalog_ids, timings)
+        for _ in range(iterations):
+            user.walk()
+
+    threads = [
+        threading.Thread(target=run_user, args=(first_user_id + number,))
+        for number in range(users_count)
+    ]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, errors, time.perf_counter() - started_at
+
+
+def make_report(timings, errors, elapsed, moltin_server, telegram_server):
+    all_timings = [timing for step_timings in timings.values() for timing in step_timings]
+    steps = {
+        step: {
+            'count': len(step_timings),
+            'errors': errors[step],
+            'p50_ms': percentile(step_timings, 50) * 1000,
+            'p95_ms': percentile(step_timings, 95) * 1000,
+            'p99_ms': percentile(step_timings, 99) * 1000,
+        }
+        for step, step_timings in timings.items()
+    }
+    return {
+        'updates': len(all_timings),
+        'errors': sum(errors.values()),
+        'elapsed_seconds': elapsed,
+        'updates_per_second': len(all_timings) / elapsed if elapsed else 0,
+        'p50_ms': percentile(all_timings, 50) * 1000,
+        'p95_ms': percentile(all_timings, 95) * 1000,
+        'p99_ms': percentile(all_timings, 99) * 1000,
+        'steps': steps,
+        'moltin_requests': dict(moltin_server.requests),
+        'telegram_requests': dict(telegram_server.requests),
+    }
+
+
+def print_report(report):
+    print(f'{"step":<14}{"count":>8}{"errors":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for step, step_report in report['steps'].items():
+        print(
+            f'{step:<14}{step_report["count"]:>8}{step_report["errors"]:>8}'
+            f'{step_report["p50_ms"]:>10.1f}{step_report["p95_ms"]:>10.1f}{step_report["p99_ms"]:>10.1f}'
+        )
+    print(
+        f'{"total":<14}{report["updates"]:>8}{report["errors"]:>8}'
+        f'{report["p50_ms"]:>10.1f}{report["p95_ms"]:>10.1f}{report["p99_ms"]:>10.1f}'
+    )
+    print(f'\n{report["updates_per_second"]:.1f} updates/sec over {report["elapsed_seconds"]:.1f}s')
+    print(f'Elastic Path requests: {report["moltin_requests"]}')
+    print(f'Telegram requests: {report["telegram_requests"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Прогоняет сценарий покупки для N пользователей против локальных заглушек Elastic Path и Telegram'
+    )
+    parser.add_argument('--users', type=int, default=20, help='количество одновременных пользователей')
+    parser.add_argument('--iterations', type=int, default=5, help='количество покупок на пользователя')
+    parser.add_argument('--products', type=int, default=50, help='размер каталога')
+    parser.add_argument('--moltin-latency', type=float, default=0.05, help='задержка ответа Elastic Path, сек')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='задержка ответа Telegram, сек')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15', help='адрес redis для бота')
+    parser.add_argument('--json', action='store_true', help='вывести отчёт в формате JSON')
+    args = parser.parse_args()
+
+    moltin_server = FakeMoltinServer(products_count=args.products, latency=args.moltin_latency)
+    moltin_server.start()
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency)
+    telegram_server.start()
+
+    configure_client(ApiClient(base_url=moltin_server.url, pool_maxsize=args.users * 2))
+    moltin_async.configure_client(moltin_async.AsyncApiClient(base_url=moltin_server.url))
+    redis_client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    bot = telegram.Bot(token=BOT_TOKEN, base_url=telegram_server.base_url)
+    dispatcher = Dispatcher(bot, Queue(), use_context=True)
+    setup_dispatcher(Env(), dispatcher, redis_client, 'client-id', 'client-secret', ADMIN_CHAT_ID)
+    while not dispatcher.bot_data['catalog'].loaded:
+        time.sleep(0.1)
+    moltin_server.requests.clear()
+    telegram_server.requests.clear()
+
+    timings, errors, elapsed = run_load(dispatcher, args.users, args.iterations)
+    report = make_report(timings, errors, elapsed, moltin_server, telegram_server)
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print_report(report)
+
+    # Reservations of the run are flushed before the aiohttp client and its event loop are closed
+    dispatcher.bot_data['stock_poller'].stop()
+    dispatcher.bot_data['inventory'].stop()
+    dispatcher.bot_data['event_loop'].stop()
+    moltin_server.shutdown()
+    telegram_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from moltin_api import get_prices, parse_cart, parse_product
+
+
+def make_products_page(products_count):
+    return {
+        'data': [
+            {
+                'id': f'product-{number}',
+                'type': 'product',
+                'attributes': {
+                    'name': f'Рыба {number}',
+                    'description': f'Свежая рыба {number}',
+                    'sku': f'sku-{number}',
+                    'slug': f'sku-{number}',
+                },
+                'relationships': {
+                    'main_image': {'data': {'id': f'image-{number}', 'type': 'file'}},
+                },
+            }
+            for number in range(products_count)
+        ],
+        'included': {
+            'main_images': [
+                {
+                    'id': f'image-{number}',
+                    'type': 'file',
+                    'mime_type': 'image/png',
+                    'link': {'href': f'https://files.example.com/images/product-{number}.png'},
+                }
+                for number in range(products_count)
+            ],
+        },
+    }
+
+
+def make_price_book(products_count):
+    return {
+        'included': [
+            {
+                'type': 'product-price',
+                'attributes': {
+                    'sku': f'sku-{number}',
+                    'currencies': {'USD': {'amount': 1000 + number, 'includes_tax': False}},
+                },
+            }
+            for number in range(products_count)
+        ],
+    }
+
+
+def make_cart(items_count):
+    return {
+        'data': [
+            {
+                'id': f'item-{number}',
+                'type': 'cart_item',
+                'product_id': f'product-{number}',
+                'name': f'Рыба {number}',
+                'quantity': 5,
+                'meta': {'display_price': {'without_discount': {'value': {'amount': 5000 + number}}}},
+            }
+            for number in range(items_count)
+        ],
+    }
+
+
+# The dict based parsing and handler code as it was before the models, kept as the baseline
+
+def parse_product_dict(product, main_images):
+    product_attributes = product['attributes']
+    main_image_id = product['relationships']['main_image']['data']['id']
+    main_image = main_images[main_image_id]
+    return {
+        'id': product['id'],
+        'name': product_attributes['name'],
+        'description': product_attributes['description'],
+        'sku': product_attributes['sku'],
+        'slug': product_attributes['slug'],
+        'image_url': main_image['link']['href'],
+        'image_type': main_image['mime_type'].split('/')[1]
+    }
+
+
+def get_prices_dict(price_book):
+    prices = {}
+    for price in price_book['included']:
+        price_attributes = price['attributes']
+        prices[price_attributes['sku']] = price_attributes['currencies']['USD']['amount'] / 100
+    return prices
+
+
+def render_card_dict(product, prices):
+    price = prices[product['sku']]
+    return f'{product["name"]}\n\n${price} за кг\n\n{product["description"]}', f'1 {product["id"]}'
+
+
+def render_card_model(product, prices):
+    price = prices[product.sku]
+    return f'{product.name}\n\n${price.amount} за кг\n\n{product.description}', f'1 {product.id}'
+
+
+def render_cart_dict(cart):
+    message = ''
+    total_price = 0
+    for product in cart['data']:
+        product_cost = product['meta']['display_price']['without_discount']['value']['amount'] / 100
+        total_price += product_cost
+        message += f'{product["name"]}\n{product["quantity"]} кг в корзине на ${product_cost}\n\n'
+    return f'{message}Всего: ${total_price}'
+
+
+def render_cart_model(cart):
+    message = ''
+    for cart_item in cart.items:
+        message += f'{cart_item.name}\n{cart_item.quantity} кг в корзине на ${cart_item.cost}\n\n'
+    return f'{message}Всего: ${cart.total}'
+
+
+def measure_memory(build):
+    gc.collect()
+    tracemalloc.start()
+    started_at = tracemalloc.get_traced_memory()[0]
+    result = build()
+    used = tracemalloc.get_traced_memory()[0] - started_at
+    tracemalloc.stop()
+    return result, used
+
+
+def measure_seconds(function, repeat):
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started_at) / repeat
+
+
+def parse_catalog(page, parse):
+    main_images = {main_image['id']: main_image for main_image in page['included']['main_images']}
+    return [parse(product, main_images) for product in page['data']]
+
+
+def run(products_count, cart_items_count, repeat):
+    page = make_products_page(products_count)
+    price_book = make_price_book(products_count)
+    # Cart responses come from the cart cache as JSON, so the dict version keeps a decoded copy per cart
+    encoded_cart = json.dumps(make_cart(cart_items_count))
+
+    dict_products, dict_catalog_bytes = measure_memory(lambda: parse_catalog(page, parse_product_dict))
+    model_products, model_catalog_bytes = measure_memory(lambda: parse_catalog(page, parse_product))
+    dict_prices, dict_prices_bytes = measure_memory(lambda: get_prices_dict(price_book))
+    model_prices, model_prices_bytes = measure_memory(lambda: get_prices(price_book))
+    dict_cart, dict_cart_bytes = measure_memory(lambda: json.loads(encoded_cart))
+    model_cart, model_cart_bytes = measure_memory(lambda: parse_cart(json.loads(encoded_cart)))
+
+    card_repeat = max(1, repeat // 10)
+    return {
+        'products': products_count,
+        'cart_items': cart_items_count,
+        'memory_bytes': {
+            'catalog_dict': dict_catalog_bytes,
+            'catalog_model': model_catalog_bytes,
+            'prices_dict': dict_prices_bytes,
+            'prices_model': model_prices_bytes,
+            'cart_dict': dict_cart_bytes,
+            'cart_model': model_cart_bytes,
+        },
+        'seconds': {
+            'parse_catalog_dict': measure_seconds(lambda: parse_catalog(page, parse_product_dict), card_repeat),
+            'parse_catalog_model': measure_seconds(lambda: parse_catalog(page, parse_product), card_repeat),
+            'render_cards_dict': measure_seconds(
+                lambda: [render_card_dict(product, dict_prices) for product in dict_products], card_repeat
+            ),
+            'render_cards_model': measure_seconds(
+                lambda: [render_card_model(product, model_prices) for product in model_products], card_repeat
+            ),
+            'render_cart_dict': measure_seconds(lambda: render_cart_dict(dict_cart), repeat),
+            'render_cart_model': measure_seconds(lambda: render_cart_model(model_cart), repeat),
+        },
+    }
+
+
+def print_report(report):
+    print(f'{report["products"]} products, {report["cart_items"]} cart items')
+    print(f'{"memory":<16}{"dict KiB":>12}{"model KiB":>12}{"ratio":>8}')
+    memory = report['memory_bytes']
+    for name in ('catalog', 'prices', 'cart'):
+        dict_bytes = memory[f'{name}_dict']
+        model_bytes = memory[f'{name}_model']
+        print(f'{name:<16}{dict_bytes / 1024:>12.1f}{model_bytes / 1024:>12.1f}{model_bytes / dict_bytes:>8.2f}')
+    print(f'\n{"time":<16}{"dict µs":>12}{"model µs":>12}{"ratio":>8}')
+    seconds = report['seconds']
+    for name in ('parse_catalog', 'render_cards', 'render_cart'):
+        dict_seconds = seconds[f'{name}_dict']
+        model_seconds = seconds[f'{name}_model']
+        print(
+            f'{name:<16}{dict_seconds * 10 ** 6:>12.1f}{model_seconds * 10 ** 6:>12.1f}'
+            f'{model_seconds / dict_seconds:>8.2f}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Сравнивает память и скорость моделей товаров, цен и корзины с разбором в словари'
+    )
+    parser.add_argument('--products', type=int, default=10000, help='размер каталога')
+    parser.add_argument('--cart-items', type=int, default=20, help='количество позиций в корзине')
+    parser.add_argument('--repeat', type=int, default=1000, help='количество повторов замеров времени')
+    parser.add_argument('--json', action='store_true', help='вывести отчёт в формате JSON')
+    args = parser.parse_args()
+
+    report = run(args.products, args.cart_items, args.repeat)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+
+from models import Cart
+
+
+class CartCache:
+    # With a redis client the carts live only in redis, so every bot instance sees the latest mutation.
+    # Without it they are kept in process memory
+
+    def __init__(self, redis_client=None, ttl=300, prefix='cart'):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._carts = {}
+        self._next_eviction = 0
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        if self.redis_client:
+            encoded_cart = self.redis_client.get(f'{self.prefix}:{chat_id}')
+            cart = self._decode(encoded_cart) if encoded_cart else None
+        else:
+            with self._lock:
+                expires_at, cart = self._carts.get(chat_id, (0, None))
+            if expires_at < time.monotonic():
+                cart = None
+
+        if cart is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cart
+
+    def _decode(self, encoded_cart):
+        # Carts cached as raw Elastic Path responses by an older version are read as misses
+        try:
+            return Cart.load(json.loads(encoded_cart))
+        except (TypeError, ValueError):
+            return None
+
+    def put(self, chat_id, cart):
+        if self.redis_client:
+            self.redis_client.set(f'{self.prefix}:{chat_id}', json.dumps(cart.dump()), ex=self.ttl)
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._carts[chat_id] = (now + self.ttl, cart)
+            if now >= self._next_eviction:
+                self._evict_expired(now)
+                self._next_eviction = now + self.ttl
+
+    def invalidate(self, chat_id):
+        self.invalidations += 1
+        if self.redis_client:
+            self.redis_client.delete(f'{self.prefix}:{chat_id}')
+            return
+        with self._lock:
+            self._carts.pop(chat_id, None)
+
+    def _evict_expired(self, now):
+        for chat_id, (expires_at, _) in list(self._carts.items()):
+            if expires_at < now:
+                del self._carts[chat_id]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'carts': len(self._carts),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,56 @@
+import logging
+import threading
+
+
+class Catalog:
+
+    def __init__(self, products=()):
+        self.products = []
+        self.by_id = {}
+        self.by_sku = {}
+        self.keyboard = None
+        self.product_cards = {}
+        self.loaded = True
+        self.add_page(products)
+
+    def __len__(self):
+        return len(self.products)
+
+    def __iter__(self):
+        return iter(self.products)
+
+    def __contains__(self, product_id):
+        return product_id in self.by_id
+
+    def add(self, product):
+        self.products.append(product)
+        self.by_id[product.id] = product
+        self.by_sku[product.sku] = product
+        self.keyboard = None
+
+    def add_page(self, products):
+        for product in products:
+            self.add(product)
+
+    def get(self, product_id):
+        return self.by_id[product_id]
+
+    def get_by_sku(self, sku):
+        return self.by_sku[sku]
+
+    def _load_pages(self, pages):
+        try:
+            for products in pages:
+                self.add_page(products)
+        except Exception as error:
+            logging.error(f'Catalog loading stopped after {len(self)} products: {error}')
+        else:
+            logging.info(f'Catalog loaded: {len(self)} products')
+        finally:
+            self.loaded = True
+
+    def load_in_background(self, pages):
+        self.loaded = False
+        thread = threading.Thread(target=self._load_pages, args=(pages,), name='catalog-loader', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+from moltin_api import get_products
+
+logger = logging.getLogger('bot_logger')
+
+
+def diff_catalogs(old_catalog, new_catalog):
+    old_ids = old_catalog.by_id.keys()
+    new_ids = new_catalog.by_id.keys()
+    added = new_ids - old_ids
+    removed = old_ids - new_ids
+    changed = {
+        product_id for product_id in new_ids & old_ids
+        if new_catalog.get(product_id) != old_catalog.get(product_id)
+    }
+    return added, removed, changed
+
+
+class CatalogRefresher:
+
+    def __init__(self, bot_data, token_manager, price_index, interval=600, page_limit=100):
+        self.bot_data = bot_data
+        self.token_manager = token_manager
+        self.price_index = price_index
+        self.interval = interval
+        self.page_limit = page_limit
+        self.reloads = 0
+        self.last_reload_seconds = 0
+        self._triggered = threading.Event()
+        self._stopped = threading.Event()
+
+    def reload(self):
+        current_catalog = self.bot_data['catalog']
+        if not current_catalog.loaded:
+            logging.info('Catalog reload skipped: initial loading is still in progress')
+            return
+
+        started_at = time.monotonic()
+        new_catalog = get_products(self.token_manager.get_access_token(), self.page_limit)
+        added, removed, changed = diff_catalogs(current_catalog, new_catalog)
+        if added or removed or changed:
+            self.bot_data['catalog'] = new_catalog
+            self.price_index.invalidate()
+        self.last_reload_seconds = time.monotonic() - started_at
+        self.reloads += 1
+
+        message = (
+            f'Catalog reloaded in {self.last_reload_seconds:.2f}s: {len(new_catalog)} products, '
+            f'{len(added)} added, {len(removed)} removed, {len(changed)} changed'
+        )
+        if added or removed or changed:
+            logger.info(message)
+        else:
+            logging.info(message)
+
+    def trigger(self):
+        self._triggered.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._triggered.wait(self.interval or None)
+            self._triggered.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.reload()
+            except Exception as error:
+                logger.error(f'Catalog reload failed: {error}')
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='catalog-refresher', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+        self._triggered.set()
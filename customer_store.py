@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+
+
+class CustomerStore:
+    # Customer ids of all chats live in one redis hash. Chats registered before it still have an
+    # `id {chat_id}` string key, it is read in the same pipeline and moved into the hash
+
+    def __init__(self, redis_client, key='customer_ids', cache_size=10000):
+        self.redis_client = redis_client
+        self.key = key
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.migrated = 0
+        self._customer_ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, chat_id, customer_id):
+        with self._lock:
+            self._customer_ids[chat_id] = customer_id
+            self._customer_ids.move_to_end(chat_id)
+            if len(self._customer_ids) > self.cache_size:
+                self._customer_ids.popitem(last=False)
+
+    def get_customer_id(self, chat_id):
+        with self._lock:
+            customer_id = self._customer_ids.get(chat_id)
+            if customer_id is not None:
+                self._customer_ids.move_to_end(chat_id)
+        if customer_id is not None:
+            self.hits += 1
+            return customer_id
+
+        # Unknown chats are not cached, they may register on another bot instance
+        self.misses += 1
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.hget(self.key, chat_id)
+        pipeline.get(f'id {chat_id}')
+        customer_id, legacy_customer_id = pipeline.execute()
+        if customer_id is None and legacy_customer_id is not None:
+            customer_id = legacy_customer_id
+            self._write(chat_id, customer_id)
+            self.migrated += 1
+        if customer_id is not None:
+            self._remember(chat_id, customer_id)
+        return customer_id
+
+    def _write(self, chat_id, customer_id):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.hset(self.key, chat_id, customer_id)
+        pipeline.delete(f'id {chat_id}')
+        pipeline.execute()
+
+    def set_customer_id(self, chat_id, customer_id):
+        if self.get_cached(chat_id) == customer_id:
+            return
+        self._write(chat_id, customer_id)
+        self._remember(chat_id, customer_id)
+
+    def get_cached(self, chat_id):
+        with self._lock:
+            return self._customer_ids.get(chat_id)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'cached': len(self._customer_ids),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'migrated': self.migrated,
+        }
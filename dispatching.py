@@ -0,0 +1,68 @@
+import queue
+import threading
+import time
+
+from telegram.ext import Dispatcher
+
+
+class BoundedUpdateQueue(queue.Queue):
+
+    def __init__(self, maxsize=100):
+        super().__init__(maxsize)
+        self.dequeued = 0
+        self.wait_seconds = 0
+        self.max_wait_seconds = 0
+        self.last_wait_seconds = 0
+
+    def _put(self, item):
+        self.queue.append((time.monotonic(), item))
+
+    def _get(self):
+        enqueued_at, item = self.queue.popleft()
+        self.last_wait_seconds = time.monotonic() - enqueued_at
+        self.wait_seconds += self.last_wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, self.last_wait_seconds)
+        self.dequeued += 1
+        return item
+
+    def stats(self):
+        return {
+            'depth': self.qsize(),
+            'max_size': self.maxsize,
+            'dequeued': self.dequeued,
+            'wait_seconds_total': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+            'last_wait_seconds': self.last_wait_seconds,
+        }
+
+
+class BoundedDispatcher(Dispatcher):
+
+    def __init__(self, bot, update_queue, workers=8, **kwargs):
+        super().__init__(bot, update_queue, workers=workers, **kwargs)
+        self._worker_slots = threading.BoundedSemaphore(workers)
+        self._in_flight_lock = threading.Lock()
+        self.in_flight = 0
+
+    def _run_async(self, func, *args, update=None, error_handling=True, **kwargs):
+        # Block the dispatcher thread while every worker is busy, so updates pile up in the bounded
+        # update queue and the webhook or the poller feels the backpressure
+        self._worker_slots.acquire()
+        with self._in_flight_lock:
+            self.in_flight += 1
+
+        def run_in_slot(*func_args, **func_kwargs):
+            try:
+                return func(*func_args, **func_kwargs)
+            finally:
+                with self._in_flight_lock:
+                    self.in_flight -= 1
+                self._worker_slots.release()
+
+        return super()._run_async(run_in_slot, *args, update=update, error_handling=error_handling, **kwargs)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+        }
@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import threading
+import time
+
+from redis.exceptions import LockError
+
+import moltin_async
+
+RESERVE_SCRIPT = '''
+local available = redis.call('HGET', KEYS[1], ARGV[1])
+if not available then
+    return -2
+end
+local quantity = tonumber(ARGV[2])
+if tonumber(available) < quantity then
+    return -1
+end
+redis.call('HINCRBY', KEYS[2], ARGV[1], quantity)
+return redis.call('HINCRBY', KEYS[1], ARGV[1], -quantity)
+'''
+
+RELEASE_SCRIPT = '''
+redis.call('HINCRBY', KEYS[2], ARGV[1], -tonumber(ARGV[2]))
+return redis.call('HINCRBY', KEYS[1], ARGV[1], tonumber(ARGV[2]))
+'''
+
+# Taken changes stay in the in-flight hash until elasticpath has them, so a stock load in the meantime
+# does not count them as available again. Changes left there by an aborted flush go out with this one
+TAKE_PENDING_SCRIPT = '''
+local left = redis.call('HGETALL', KEYS[2])
+for index = 1, #left, 2 do
+    redis.call('HINCRBY', KEYS[1], left[index], left[index + 1])
+end
+redis.call('DEL', KEYS[2])
+local pending = redis.call('HGETALL', KEYS[1])
+if #pending > 0 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+return pending
+'''
+
+# A stock read that started before a flush sent its transactions may predate them, so its write is dropped
+# once the flush generation moved on
+SET_REMOTE_SCRIPT = '''
+if (redis.call('GET', KEYS[5]) or '0') ~= ARGV[4] then
+    local current = redis.call('HGET', KEYS[1], ARGV[1])
+    if not current then
+        return false
+    end
+    return {tonumber(current), 0}
+end
+local pending = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+local in_flight = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+local available = tonumber(ARGV[2]) - pending - in_flight
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[1], ARGV[1], available)
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[3])
+if previous and tonumber(previous) == available then
+    return {available, 0}
+end
+return {available, 1}
+'''
+
+
+class InventoryLedger:
+    # Reservations change the stock snapshot in redis at once and reach elasticpath in batches. The stock poller
+    # keeps the snapshot fresh, a read older than the bound loads the product from elasticpath itself. Products
+    # viewed within hot_window seconds are bound by max_age, the rest of the catalog by cold_max_age
+
+    def __init__(self, redis_client, token_manager, event_loop, flush_interval=2, max_age=30, cold_max_age=600,
+                 hot_window=300, prefix='inventory'):
+        self.redis_client = redis_client
+        self.token_manager = token_manager
+        self.event_loop = event_loop
+        self.flush_interval = flush_interval
+        self.max_age = max_age
+        self.cold_max_age = cold_max_age
+        self.hot_window = hot_window
+        self.available_key = f'{prefix}:available'
+        self.pending_key = f'{prefix}:pending'
+        self.in_flight_key = f'{prefix}:in_flight'
+        self.checked_at_key = f'{prefix}:checked_at'
+        self.viewed_key = f'{prefix}:viewed'
+        self.generation_key = f'{prefix}:flush_generation'
+        self.lock_name = f'{prefix}:flush_lock'
+        self.reservations = 0
+        self.rejected_reservations = 0
+        self.flushed_transactions = 0
+        self.snapshot_reads = 0
+        self.stale_reads = 0
+        self.remote_loads = 0
+        self.last_flush_seconds = 0
+        self.last_reconcile_seconds = 0
+        self._reserve = redis_client.register_script(RESERVE_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+        self._take_pending = redis_client.register_script(TAKE_PENDING_SCRIPT)
+        self._set_remote = redis_client.register_script(SET_REMOTE_SCRIPT)
+        self._stopped = threading.Event()
+
+    def lock(self):
+        # Held across a flush or one chunk of a stock poll, each bounded by the request deadline
+        return self.redis_client.lock(self.lock_name, timeout=max(30, self.flush_interval * 10))
+
+    def release_lock(self, lock):
+        try:
+            lock.release()
+        except LockError as error:
+            logging.warning(f'Inventory lock expired before it was released: {error}')
+
+    def read_snapshot(self, product_id, max_age=None):
+        now = time.time()
+        # The view is recorded in the same round trip, recently viewed products are polled more often
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.hget(self.available_key, product_id)
+        pipeline.hget(self.checked_at_key, product_id)
+        pipeline.zscore(self.viewed_key, product_id)
+        pipeline.zadd(self.viewed_key, {product_id: now})
+        available, checked_at, viewed_at, _ = pipeline.execute()
+        if max_age is None:
+            is_hot = viewed_at is not None and now - viewed_at <= self.hot_window
+            max_age = self.max_age if is_hot else self.cold_max_age
+
+        if available is None:
+            self.stale_reads += 1
+            return None, False
+        if checked_at is not None and (not max_age or now - float(checked_at) <= max_age):
+            self.snapshot_reads += 1
+            return int(available), True
+        self.stale_reads += 1
+        return int(available), False
+
+    def _fall_back(self, product_id, snapshot, error):
+        if snapshot is None:
+            raise error
+        logging.warning(f'Stock of {product_id} not loaded, a stale snapshot is shown: {error}')
+        return snapshot
+
+    def refresh(self, product_id, snapshot):
+        try:
+            return self.load(product_id)
+        except Exception as error:
+            return self._fall_back(product_id, snapshot, error)
+
+    def store_load(self, product_id, snapshot, remote_quantity, generation):
+        # Stores a stock read the caller made itself, an error in place of the quantity falls back to the snapshot
+        if isinstance(remote_quantity, BaseException):
+            return self._fall_back(product_id, snapshot, remote_quantity)
+        self.remote_loads += 1
+        available, _ = self._store_remote(product_id, remote_quantity, generation)
+        if available is None:
+            return self.refresh(product_id, snapshot)
+        return available
+
+    def get_available(self, product_id, max_age=None):
+        available, is_fresh = self.read_snapshot(product_id, max_age)
+        if is_fresh:
+            return available
+        return self.refresh(product_id, available)
+
+    def get_generation(self):
+        return self.redis_client.get(self.generation_key) or '0'
+
+    def _store_remote(self, product_id, remote_quantity, generation):
+        result = self._set_remote(
+            keys=[self.available_key, self.pending_key, self.in_flight_key, self.checked_at_key, self.generation_key],
+            args=[product_id, remote_quantity, time.time(), generation],
+        )
+        if result is None:
+            return None, False
+        available, changed = result
+        return available, bool(changed)
+
+    def load(self, product_id, attempts=3):
+        access_token = self.token_manager.get_access_token()
+        for _ in range(attempts):
+            generation = self.get_generation()
+            remote_quantity = self.event_loop.run(moltin_async.get_product_quantity(access_token, product_id))
+            self.remote_loads += 1
+            available, _ = self._store_remote(product_id, remote_quantity, generation)
+            # Dropped as stale with no snapshot to fall back to, so the product is read again
+            if available is not None:
+                return available
+        raise RuntimeError(f'Stock of {product_id} kept changing while it was loaded')
+
+    def reserve(self, product_id, quantity, fresh=False):
+        if fresh:
+            try:
+                self.load(product_id)
+            except Exception as error:
+                logging.warning(f'Stock of {product_id} not loaded, reserving from the snapshot: {error}')
+        result = self._reserve(keys=[self.available_key, self.pending_key], args=[product_id, int(quantity)])
+        if result == -2:
+            self.load(product_id)
+            result = self._reserve(keys=[self.available_key, self.pending_key], args=[product_id, int(quantity)])
+        if result < 0:
+            self.rejected_reservations += 1
+            return False
+        self.reservations += 1
+        return True
+
+    def release(self, product_id, quantity):
+        self._release(keys=[self.available_key, self.pending_key], args=[product_id, int(quantity)])
+
+    async def _send_transactions(self, access_token, net_changes):
+        product_ids = list(net_changes)
+        results = await asyncio.gather(
+            *(
+                moltin_async.update_product_quantity(
+                    access_token,
+                    product_id,
+                    abs(net_changes[product_id]),
+                    'allocate' if net_changes[product_id] > 0 else 'deallocate',
+                )
+                for product_id in product_ids
+            ),
+            return_exceptions=True,
+        )
+        return {
+            product_id: result for product_id, result in zip(product_ids, results)
+            if isinstance(result, BaseException)
+        }
+
+    def _requeue(self, net_changes):
+        pipeline = self.redis_client.pipeline()
+        for product_id, quantity in net_changes.items():
+            pipeline.hincrby(self.pending_key, product_id, quantity)
+        pipeline.delete(self.in_flight_key)
+        pipeline.execute()
+
+    def flush(self):
+        started_at = time.monotonic()
+        taken = self._take_pending(keys=[self.pending_key, self.in_flight_key])
+        net_changes = {
+            product_id: int(quantity) for product_id, quantity in zip(taken[::2], taken[1::2])
+            if int(quantity)
+        }
+        if not net_changes:
+            self.redis_client.delete(self.in_flight_key)
+            return
+
+        try:
+            access_token = self.token_manager.get_access_token()
+            failures = self.event_loop.run(self._send_transactions(access_token, net_changes))
+        except Exception:
+            # Nothing is known to have reached elasticpath, the whole batch goes out with the next flush
+            self._requeue(net_changes)
+            raise
+        pipeline = self.redis_client.pipeline()
+        for product_id, error in failures.items():
+            logging.warning(f'Stock transaction for {product_id} failed: {error}')
+            pipeline.hincrby(self.pending_key, product_id, net_changes[product_id])
+        pipeline.delete(self.in_flight_key)
+        pipeline.incr(self.generation_key)
+        pipeline.execute()
+        self.flushed_transactions += len(net_changes) - len(failures)
+        self.last_flush_seconds = time.monotonic() - started_at
+
+    def reconcile(self, product_ids=None, concurrency=10):
+        started_at = time.monotonic()
+        if product_ids is None:
+            product_ids = self.redis_client.hkeys(self.available_key)
+        changed = set()
+        failed = set()
+        if not product_ids:
+            return changed, failed
+
+        access_token = self.token_manager.get_access_token()
+        generation = self.get_generation()
+        remote_quantities = self.event_loop.run(
+            moltin_async.get_product_quantities(access_token, product_ids, concurrency)
+        )
+        for product_id, remote_quantity in remote_quantities.items():
+            if isinstance(remote_quantity, BaseException):
+                logging.warning(f'Stock of {product_id} not reconciled: {remote_quantity}')
+                failed.add(product_id)
+                continue
+            _, is_changed = self._store_remote(product_id, remote_quantity, generation)
+            if is_changed:
+                changed.add(product_id)
+        self.last_reconcile_seconds = time.monotonic() - started_at
+        return changed, failed
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            # One process at a time flushes, the stock poller takes the same lock
+            flush_lock = self.lock()
+            if not flush_lock.acquire(blocking=False):
+                continue
+            try:
+                self.flush()
+            except Exception as error:
+                logging.warning(f'Inventory flush failed: {error}')
+            finally:
+                self.release_lock(flush_lock)
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='inventory-ledger', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def stats(self):
+        return {
+            'reservations': self.reservations,
+            'rejected_reservations': self.rejected_reservations,
+            'flushed_transactions': self.flushed_transactions,
+            'pending_products': self.redis_client.hlen(self.pending_key),
+            'snapshot_reads': self.snapshot_reads,
+            'stale_reads': self.stale_reads,
+            'remote_loads': self.remote_loads,
+            'last_flush_seconds': self.last_flush_seconds,
+            'last_reconcile_seconds': self.last_reconcile_seconds,
+        }
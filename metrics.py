@@ -0,0 +1,116 @@
+import asyncio
+import functools
+import re
+import time
+from urllib.parse import urlsplit
+
+from prometheus_client import Counter, Histogram, start_http_server, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+MOLTIN_REQUEST_SECONDS = Histogram(
+    'moltin_request_seconds',
+    'Elastic Path HTTP request latency',
+    ['method', 'endpoint'],
+)
+MOLTIN_RESPONSES = Counter(
+    'moltin_responses_total',
+    'Elastic Path HTTP responses by status code, 0 for connection errors',
+    ['method', 'endpoint', 'status'],
+)
+MOLTIN_CALL_SECONDS = Histogram(
+    'moltin_call_seconds',
+    'Latency of moltin_api and moltin_async functions',
+    ['function'],
+)
+MOLTIN_CALL_ERRORS = Counter(
+    'moltin_call_errors_total',
+    'Failed moltin_api and moltin_async calls',
+    ['function', 'error'],
+)
+HANDLER_SECONDS = Histogram(
+    'bot_handler_seconds',
+    'Latency of the bot handlers',
+    ['handler'],
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total',
+    'Bot handlers that raised',
+    ['handler', 'error'],
+)
+TELEGRAM_REQUEST_SECONDS = Histogram(
+    'telegram_request_seconds',
+    'Latency of the queued Telegram Bot API calls',
+    ['method'],
+)
+
+ID_SEGMENT = re.compile(r'[0-9a-fA-F-]{8,}|\d+|[^/]+\.(png|jpe?g|gif|webp)')
+
+
+def endpoint_label(url):
+    segments = urlsplit(url).path.split('/')
+    return '/'.join('{id}' if ID_SEGMENT.fullmatch(segment) else segment for segment in segments)
+
+
+def observe_response(method, url, status, seconds):
+    endpoint = endpoint_label(url)
+    MOLTIN_REQUEST_SECONDS.labels(method, endpoint).observe(seconds)
+    MOLTIN_RESPONSES.labels(method, endpoint, str(status)).inc()
+
+
+def timed(histogram, errors):
+    def decorator(function):
+        name = function.__name__
+        seconds = histogram.labels(name)
+
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                except Exception as error:
+                    errors.labels(name, type(error).__name__).inc()
+                    raise
+                finally:
+                    seconds.observe(time.perf_counter() - started_at)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                errors.labels(name, type(error).__name__).inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started_at)
+        return wrapper
+    return decorator
+
+
+moltin_call = timed(MOLTIN_CALL_SECONDS, MOLTIN_CALL_ERRORS)
+bot_handler = timed(HANDLER_SECONDS, HANDLER_ERRORS)
+
+
+class StatsCollector:
+    # Publishes the stats() of the bot components at scrape time, so they cost nothing between scrapes
+
+    def __init__(self, components):
+        self.components = components
+
+    def collect(self):
+        for component_name, component in list(self.components.items()):
+            try:
+                stats = component.stats()
+            except Exception:
+                continue
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                yield GaugeMetricFamily(f'bot_{component_name}_{key}', f'{component_name} {key}', value=value)
+
+
+def start_metrics_server(port, components, address='127.0.0.1'):
+    REGISTRY.register(StatsCollector(components))
+    start_http_server(port, addr=address)
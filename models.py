@@ -0,0 +1,47 @@
+from dataclasses import astuple, dataclass
+
+
+# Slotted records instead of the nested JSON of Elastic Path: no per-instance __dict__ and attribute
+# reads instead of chains of key lookups. They are shared between handler threads and never mutated.
+# They are not frozen, a frozen dataclass sets every field through object.__setattr__ and parses twice as slow
+
+
+@dataclass(slots=True)
+class Product:
+    id: str
+    name: str
+    description: str
+    sku: str
+    slug: str
+    image_url: str
+    image_type: str
+
+
+@dataclass(slots=True)
+class Price:
+    sku: str
+    amount: float
+    currency: str = 'USD'
+
+
+@dataclass(slots=True)
+class CartItem:
+    id: str
+    product_id: str
+    name: str
+    quantity: int
+    cost: float
+
+
+@dataclass(slots=True)
+class Cart:
+    items: tuple
+    total: float
+
+    def dump(self):
+        return [astuple(item) for item in self.items]
+
+    @classmethod
+    def load(cls, dumped_items):
+        items = tuple(CartItem(*item) for item in dumped_items)
+        return cls(items, sum(item.cost for item in items))
@@ -1,223 +1,290 @@
-import json
+import functools
 import logging
+import threading
 import time
 
 import requests
-
-
-def get_access_token(redis_client):
-    expires_timestamp = float(redis_client.get('expires_timestamp'))
-    access_token = redis_client.get('access_token')
-    client_id = redis_client.get('client_id')
-    client_secret = redis_client.get('client_secret')
-    current_timestamp = time.time()
-
-    if not expires_timestamp or current_timestamp > expires_timestamp:
-
-        url = 'https://useast.api.elasticpath.com/oauth/access_token'
+from requests.adapters import HTTPAdapter
+
+from catalog import Catalog
+from metrics import moltin_call, observe_response
+from models import Cart, CartItem, Price, Product
+from resilience import ResiliencePolicy
+
+API_URL = 'https://useast.api.elasticpath.com'
+
+
+def create_session(pool_connections=4, pool_maxsize=16):
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def error_status(error):
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    if isinstance(error, requests.RequestException):
+        return 0
+    return None
+
+
+class ApiClient:
+
+    def __init__(self, base_url=API_URL, timeout=(3.05, 10), session=None, policy=None, **session_kwargs):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = session or create_session(**session_kwargs)
+        self.policy = policy or ResiliencePolicy()
+
+    def _send(self, method, url, headers, kwargs, remaining_seconds):
+        # Never wait on a socket past the deadline of the whole call
+        timeout = tuple(min(part, max(remaining_seconds, 0.01)) for part in self.timeout)
+        started_at = time.perf_counter()
+        try:
+            response = self.session.request(method, url, headers=headers, timeout=timeout, **kwargs)
+        except requests.RequestException:
+            observe_response(method, url, 0, time.perf_counter() - started_at)
+            raise
+        observe_response(method, url, response.status_code, time.perf_counter() - started_at)
+        response.raise_for_status()
+        return response
+
+    def request(self, method, url, access_token=None, headers=None, **kwargs):
+        if not url.startswith(('http://', 'https://')):
+            url = f'{self.base_url}{url}'
+        headers = dict(headers or {})
+        if access_token:
+            headers['Authorization'] = f'Bearer {access_token}'
+        return self.policy.call(
+            method,
+            url,
+            functools.partial(self._send, method, url, headers, kwargs),
+            error_status,
+            params=kwargs.get('params'),
+        )
+
+    def close(self):
+        self.session.close()
+
+
+client = ApiClient()
+
+
+def configure_client(api_client):
+    global client
+    client.close()
+    client = api_client
+    return client
+
+
+class AccessTokenManager:
+
+    def __init__(self, redis_client, client_id, client_secret, refresh_margin=60, lock_timeout=10):
+        self.redis_client = redis_client
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.lock_timeout = lock_timeout
+        self.access_token = None
+        self.expires_timestamp = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_seconds = 0
+        self.last_refresh_seconds = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def is_fresh(self, expires_timestamp):
+        return time.time() < expires_timestamp - self.refresh_margin
+
+    def get_access_token(self):
+        if self.access_token and self.is_fresh(self.expires_timestamp):
+            self.hits += 1
+            return self.access_token
+
+        with self._lock:
+            if self.access_token and self.is_fresh(self.expires_timestamp):
+                self.hits += 1
+                return self.access_token
+            self.misses += 1
+            self._load_or_refresh()
+
+        return self.access_token
+
+    def _load_shared_token(self):
+        access_token, expires_timestamp = self.redis_client.mget('access_token', 'expires_timestamp')
+        if not access_token or not expires_timestamp or not self.is_fresh(float(expires_timestamp)):
+            return False
+        self.access_token = access_token
+        self.expires_timestamp = float(expires_timestamp)
+        return True
+
+    def _load_or_refresh(self):
+        if self._load_shared_token():
+            return
+        # Other bot processes share the token through redis, so only one of them should refresh it
+        redis_lock = self.redis_client.lock(
+            'access_token_lock',
+            timeout=self.lock_timeout,
+            blocking_timeout=self.lock_timeout,
+        )
+        with redis_lock:
+            if self._load_shared_token():
+                return
+            self._refresh()
+
+    def _refresh(self):
+        started_at = time.monotonic()
         data = {
-            'client_id': client_id,
+            'client_id': self.client_id,
             'grant_type': 'client_credentials',
-            'client_secret': client_secret
+            'client_secret': self.client_secret
         }
-        response = requests.post(url, data=data)
-        response.raise_for_status()
+        response = client.request('POST', '/oauth/access_token', data=data)
         response_content = response.json()
-        access_token = response_content['access_token']
-        expires_timestamp = response_content['expires']
-        redis_client.set('expires_timestamp', expires_timestamp)
-        redis_client.set('access_token', access_token)
+        self.access_token = response_content['access_token']
+        self.expires_timestamp = float(response_content['expires'])
+        self.redis_client.mset({
+            'access_token': self.access_token,
+            'expires_timestamp': self.expires_timestamp,
+        })
+        self.last_refresh_seconds = time.monotonic() - started_at
+        self.refresh_seconds += self.last_refresh_seconds
+        self.refreshes += 1
         logging.info('New token generated')
 
-    return access_token
-
-
-def add_to_cart(access_token, product_id, quantity, chat_id):
-    url = f'https://useast.api.elasticpath.com/v2/carts/{chat_id}/items'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    data = {
-        'data': {
-            'id': product_id,
-            'type': 'cart_item',
-            'quantity': int(quantity),
+    def _run_refresher(self):
+        while not self._stopped.is_set():
+            refresh_in = self.expires_timestamp - self.refresh_margin - time.time()
+            if refresh_in > 0 and self._stopped.wait(refresh_in):
+                break
+            try:
+                with self._lock:
+                    if not self.is_fresh(self.expires_timestamp):
+                        self._load_or_refresh()
+            except Exception as error:
+                logging.warning(f'Access token refresh failed: {error}')
+                self._stopped.wait(self.lock_timeout)
+
+    def start(self):
+        self.get_access_token()
+        thread = threading.Thread(target=self._run_refresher, name='access-token-refresher', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'refreshes': self.refreshes,
+            'refresh_seconds_total': self.refresh_seconds,
+            'last_refresh_seconds': self.last_refresh_seconds,
+            'expires_in': self.expires_timestamp - time.time(),
         }
-    }
-    data = json.dumps(data)
-    response = requests.post(url, headers=headers, data=data)
-    response.raise_for_status()
-    return response.json()
-
-
-def delete_from_cart(access_token, product_id, chat_id):
-    url = f'https://useast.api.elasticpath.com/v2/carts/{chat_id}/items/{product_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
 
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
 
+def parse_product(product, main_images):
+    product_attributes = product['attributes']
+    main_image_id = product['relationships']['main_image']['data']['id']
+    main_image = main_images[main_image_id]
+    return Product(
+        product['id'],
+        product_attributes['name'],
+        product_attributes['description'],
+        product_attributes['sku'],
+        product_attributes['slug'],
+        main_image['link']['href'],
+        main_image['mime_type'].split('/')[1],
+    )
+
+
+def parse_cart(cart_items):
+    # Responses of the cart endpoints are parsed once here, handlers and the cart cache only see the models
+    items = tuple(
+        CartItem(
+            item['id'],
+            item['product_id'],
+            item['name'],
+            item['quantity'],
+            item['meta']['display_price']['without_discount']['value']['amount'] / 100,
+        )
+        for item in cart_items['data']
+    )
+    return Cart(items, sum(item.cost for item in items))
+
+
+def iter_product_pages(access_token, page_limit=100):
+    page_offset = 0
+    while True:
+        params = {
+            'include': 'main_image',
+            'page[limit]': page_limit,
+            'page[offset]': page_offset,
+        }
+        response = client.request('GET', '/pcm/products', access_token, params=params)
+        products = response.json()
 
-def get_cart_items(access_token, chat_id):
-    url = f'https://useast.api.elasticpath.com/v2/carts/{chat_id}/items'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+        main_images = {
+            main_image['id']: main_image for main_image in products.get('included', {}).get('main_images', [])
+        }
+        ordered_products = []
+        for product in products['data']:
+            try:
+                ordered_products.append(parse_product(product, main_images))
+            except (KeyError, TypeError):
+                logging.warning(f'Product {product["id"]} skipped: no main image')
+        yield ordered_products
 
-    return response.json()
+        page_offset += len(products['data'])
+        total = products.get('meta', {}).get('results', {}).get('total')
+        if len(products['data']) < page_limit or total is not None and page_offset >= total:
+            break
 
 
-def get_products(access_token):
-    url = 'https://useast.api.elasticpath.com/pcm/products'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    params = {
-        'include': 'main_image'
-    }
-
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()
-
-    products = response.json()
-
-    ordered_products = []
-    for index, product in enumerate(products['data']):
-        product_sku = product['attributes']['sku']
-        product_id = product['id']
-        ordered_product = {
-            'id': product_id,
-            'name': product['attributes']['name'],
-            'description': product['attributes']['description'],
-            'sku': product_sku,
-            'slug': product['attributes']['slug'],
-            'image_url': products['included']['main_images'][index]['link']['href'],
-            'image_type': products['included']['main_images'][index]['mime_type'].split('/')[1]
-        }
-        ordered_products.append(ordered_product)
-    return ordered_products
+@moltin_call
+def get_products(access_token, page_limit=100):
+    catalog = Catalog()
+    for ordered_products in iter_product_pages(access_token, page_limit):
+        catalog.add_page(ordered_products)
+    return catalog
 
 
+@moltin_call
 def get_price_books(access_token):
-    url = 'https://useast.api.elasticpath.com/pcm/pricebooks/'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    response = client.request('GET', '/pcm/pricebooks/', access_token)
 
     return response.json()
 
 
+@moltin_call
 def get_price_book(access_token, price_books):
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
     params = {
         'include': 'prices'
     }
     for price_book in price_books['data']:
         if price_book['attributes']['name'] == 'Fish price book':
-            url = f'https://useast.api.elasticpath.com/pcm/pricebooks/{price_book["id"]}'
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
+            url = f'/pcm/pricebooks/{price_book["id"]}'
+            response = client.request('GET', url, access_token, params=params)
 
     return response.json()
 
 
+@moltin_call
 def get_prices(price_book):
     prices = {}
     for price in price_book['included']:
         price_attributes = price['attributes']
-        prices[price_attributes['sku']] = price_attributes['currencies']['USD']['amount'] / 100
+        sku = price_attributes['sku']
+        prices[sku] = Price(sku, price_attributes['currencies']['USD']['amount'] / 100)
     return prices
-
-
-def get_product_quantity(access_token, product_id):
-    url = f'https://useast.api.elasticpath.com/v2/inventories/{product_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    product_quantity_data = response.json()
-    product_quantity = product_quantity_data['data']['available']
-
-    return product_quantity
-
-
-def get_image(access_token, product):
-    url = product['image_url']
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-
-    return response.content
-
-
-def update_product_quantity(access_token, product_id, quantity, action):
-    url = f'https://useast.api.elasticpath.com/v2/inventories/{product_id}/transactions'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    data = {
-        'data': {
-            'type': 'stock-transaction',
-            'action': action,
-            'quantity': int(quantity),
-        }
-    }
-    data = json.dumps(data)
-    response = requests.post(url, headers=headers, data=data)
-    response.raise_for_status()
-    return response.json()
-
-
-def create_customer(access_token, user_name, phone_number, email):
-    url = f'https://useast.api.elasticpath.com/v2/customers'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    data = {
-        'data': {
-            'type': 'customer',
-            'name': user_name,
-            'email': email,
-            'password': phone_number
-        }
-    }
-    data = json.dumps(data)
-    response = requests.post(url, headers=headers, data=data)
-    response.raise_for_status()
-    return response.json()
-
-
-def update_customer(access_token, user_name, phone_number, email, customer_id):
-    url = f'https://useast.api.elasticpath.com/v2/customers/{customer_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    data = {
-        'data': {
-            'type': 'customer',
-            'name': user_name,
-            'email': email,
-            'password': phone_number
-        }
-    }
-    data = json.dumps(data)
-    response = requests.put(url, headers=headers, data=data)
-    response.raise_for_status()
-    return response.json()
@@ -0,0 +1,204 @@
+import asyncio
+import functools
+import json
+import threading
+import time
+
+import aiohttp
+
+from metrics import moltin_call, observe_response
+from moltin_api import API_URL
+from resilience import ResiliencePolicy
+
+
+def error_status(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status
+    if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError)):
+        return 0
+    return None
+
+
+class AsyncApiClient:
+
+    def __init__(self, base_url=API_URL, timeout=(3.05, 10), pool_size=100, pool_size_per_host=32, policy=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.policy = policy or ResiliencePolicy()
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size_per_host,
+                keepalive_timeout=30,
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def _send(self, method, url, headers, kwargs, remaining_seconds):
+        timeout = aiohttp.ClientTimeout(
+            total=max(remaining_seconds, 0.01),
+            sock_connect=self.timeout.sock_connect,
+            sock_read=self.timeout.sock_read,
+        )
+        started_at = time.perf_counter()
+        try:
+            async with self.get_session().request(method, url, headers=headers, timeout=timeout, **kwargs) as response:
+                observe_response(method, url, response.status, time.perf_counter() - started_at)
+                response.raise_for_status()
+                return await response.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            observe_response(method, url, 0, time.perf_counter() - started_at)
+            raise
+
+    async def request(self, method, url, access_token=None, headers=None, **kwargs):
+        if not url.startswith(('http://', 'https://')):
+            url = f'{self.base_url}{url}'
+        headers = dict(headers or {})
+        if access_token:
+            headers['Authorization'] = f'Bearer {access_token}'
+        return await self.policy.call_async(
+            method,
+            url,
+            functools.partial(self._send, method, url, headers, kwargs),
+            error_status,
+            params=kwargs.get('params'),
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+client = AsyncApiClient()
+
+
+def configure_client(api_client):
+    global client
+    client = api_client
+    return client
+
+
+class EventLoopThread:
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='asyncio-loop', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self.thread
+
+    def run(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def stop(self):
+        self.run(client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@moltin_call
+async def add_to_cart(access_token, product_id, quantity, chat_id):
+    data = {
+        'data': {
+            'id': product_id,
+            'type': 'cart_item',
+            'quantity': int(quantity),
+        }
+    }
+    response = await client.request('POST', f'/v2/carts/{chat_id}/items', access_token, json=data)
+    return json.loads(response)
+
+
+@moltin_call
+async def delete_from_cart(access_token, product_id, chat_id):
+    response = await client.request('DELETE', f'/v2/carts/{chat_id}/items/{product_id}', access_token)
+    return json.loads(response)
+
+
+@moltin_call
+async def get_cart_items(access_token, chat_id):
+    response = await client.request('GET', f'/v2/carts/{chat_id}/items', access_token)
+    return json.loads(response)
+
+
+@moltin_call
+async def get_product_quantity(access_token, product_id):
+    response = await client.request('GET', f'/v2/inventories/{product_id}', access_token)
+    product_quantity_data = json.loads(response)
+    return product_quantity_data['data']['available']
+
+
+@moltin_call
+async def get_image(access_token, product):
+    return await client.request('GET', product.image_url, access_token)
+
+
+@moltin_call
+async def update_product_quantity(access_token, product_id, quantity, action):
+    data = {
+        'data': {
+            'type': 'stock-transaction',
+            'action': action,
+            'quantity': int(quantity),
+        }
+    }
+    url = f'/v2/inventories/{product_id}/transactions'
+    response = await client.request('POST', url, access_token, json=data)
+    return json.loads(response)
+
+
+@moltin_call
+async def create_customer(access_token, user_name, phone_number, email):
+    data = {
+        'data': {
+            'type': 'customer',
+            'name': user_name,
+            'email': email,
+            'password': phone_number
+        }
+    }
+    response = await client.request('POST', '/v2/customers', access_token, json=data)
+    return json.loads(response)
+
+
+@moltin_call
+async def find_customer_id(access_token, email):
+    params = {
+        'filter': f'eq(email,{email})',
+    }
+    response = await client.request('GET', '/v2/customers', access_token, params=params)
+    customers = json.loads(response)['data']
+    return customers[0]['id'] if customers else None
+
+
+@moltin_call
+async def update_customer(access_token, user_name, phone_number, email, customer_id):
+    data = {
+        'data': {
+            'type': 'customer',
+            'name': user_name,
+            'email': email,
+            'password': phone_number
+        }
+    }
+    response = await client.request('PUT', f'/v2/customers/{customer_id}', access_token, json=data)
+    return json.loads(response)
+
+
+async def get_product_quantities(access_token, product_ids, concurrency=10):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get_quantity(product_id):
+        async with semaphore:
+            return await get_product_quantity(access_token, product_id)
+
+    quantities = await asyncio.gather(
+        *(get_quantity(product_id) for product_id in product_ids),
+        return_exceptions=True,
+    )
+    return dict(zip(product_ids, quantities))
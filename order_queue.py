@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+
+import redis
+
+from async_handlers import save_customer
+
+logger = logging.getLogger('bot_logger')
+
+
+class OrderQueue:
+    # Customer writes are jobs in a redis stream read by a consumer group, so any bot instance can
+    # process them and a job survives a restart until it is acknowledged
+
+    def __init__(self, redis_client, token_manager, event_loop, customers, stream='orders', group='order-workers',
+                 workers=2, max_attempts=5, retry_delay=10, max_length=10000):
+        self.redis_client = redis_client
+        self.token_manager = token_manager
+        self.event_loop = event_loop
+        self.customers = customers
+        self.stream = stream
+        self.group = group
+        self.consumer = f'{socket.gethostname()}-{os.getpid()}'
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_length = max_length
+        self.dead_letter_stream = f'{stream}:dead'
+        self.attempts_key = f'{stream}:attempts'
+        self.submitted = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self.lag_seconds = 0
+        self.max_lag_seconds = 0
+        self.last_lag_seconds = 0
+        self._stopped = threading.Event()
+        self._create_group()
+
+    def _create_group(self):
+        try:
+            self.redis_client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as error:
+            if 'BUSYGROUP' not in str(error):
+                raise
+
+    def submit(self, chat_id, user_name, phone_number, email):
+        job = {
+            'chat_id': chat_id,
+            'user_name': user_name,
+            'phone_number': phone_number,
+            'email': email,
+        }
+        # A second tap on the contact button must not queue the same order twice
+        digest = hashlib.sha1(repr(sorted(job.items())).encode()).hexdigest()
+        if not self.redis_client.set(f'{self.stream}:submitted:{digest}', 1, nx=True, ex=60):
+            self.duplicates += 1
+            return None
+        job['submitted_at'] = time.time()
+        self.submitted += 1
+        return self.redis_client.xadd(self.stream, job, maxlen=self.max_length, approximate=True)
+
+    def _next_jobs(self):
+        # Jobs whose worker failed or died are picked up again once they were idle for retry_delay
+        claimed = self.redis_client.xautoclaim(
+            self.stream,
+            self.group,
+            self.consumer,
+            min_idle_time=int(self.retry_delay * 1000),
+            start_id='0-0',
+            count=1,
+        )
+        if claimed[1]:
+            return claimed[1]
+        response = self.redis_client.xreadgroup(self.group, self.consumer, {self.stream: '>'}, count=1, block=1000)
+        return response[0][1] if response else []
+
+    def _acknowledge(self, job_id):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.set(f'{self.stream}:done:{job_id}', 1, ex=86400)
+        pipeline.xack(self.stream, self.group, job_id)
+        pipeline.hdel(self.attempts_key, job_id)
+        pipeline.execute()
+
+    def _fail(self, job_id, job, error):
+        self.failed += 1
+        attempts = self.redis_client.hincrby(self.attempts_key, job_id, 1)
+        if attempts < self.max_attempts:
+            logging.warning(f'Order {job_id} failed, attempt {attempts}: {error}')
+            return
+        self.dead_lettered += 1
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.xadd(self.dead_letter_stream, {**job, 'job_id': job_id, 'error': str(error), 'attempts': attempts})
+        pipeline.xack(self.stream, self.group, job_id)
+        pipeline.hdel(self.attempts_key, job_id)
+        pipeline.execute()
+        logger.error(
+            f'Order of chat {job["chat_id"]} moved to {self.dead_letter_stream} after {attempts} attempts: {error}'
+        )
+
+    def process(self, job_id, job):
+        # The job is acknowledged only after the customer is saved, a redelivered job that was already
+        # done is skipped, and a retried one updates the customer created by the failed attempt
+        if self.redis_client.exists(f'{self.stream}:done:{job_id}'):
+            self.redis_client.xack(self.stream, self.group, job_id)
+            return
+
+        self.last_lag_seconds = time.time() - float(job['submitted_at'])
+        self.lag_seconds += self.last_lag_seconds
+        self.max_lag_seconds = max(self.max_lag_seconds, self.last_lag_seconds)
+        chat_id = int(job['chat_id'])
+        try:
+            access_token = self.token_manager.get_access_token()
+            customer_id = self.customers.get_customer_id(chat_id)
+            customer = self.event_loop.run(
+                save_customer(access_token, job['user_name'], job['phone_number'], job['email'], customer_id)
+            )
+            self.customers.set_customer_id(chat_id, customer['data']['id'])
+        except Exception as error:
+            self._fail(job_id, job, error)
+            return
+        self._acknowledge(job_id)
+        self.processed += 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                for job_id, job in self._next_jobs():
+                    self.process(job_id, job)
+            except Exception as error:
+                logging.warning(f'Order queue worker failed: {error}')
+                self._stopped.wait(1)
+
+    def start(self):
+        threads = [
+            threading.Thread(target=self._run, name=f'order-worker-{number}', daemon=True)
+            for number in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        pending = self.redis_client.xpending(self.stream, self.group)
+        groups = {group['name']: group for group in self.redis_client.xinfo_groups(self.stream)}
+        return {
+            'submitted': self.submitted,
+            'duplicates': self.duplicates,
+            'processed': self.processed,
+            'failed': self.failed,
+            'dead_lettered': self.dead_lettered,
+            'length': self.redis_client.xlen(self.stream),
+            'pending': pending['pending'],
+            'undelivered': groups.get(self.group, {}).get('lag'),
+            'dead_letter_length': self.redis_client.xlen(self.dead_letter_stream),
+            'lag_seconds_total': self.lag_seconds,
+            'max_lag_seconds': self.max_lag_seconds,
+            'last_lag_seconds': self.last_lag_seconds,
+        }
@@ -0,0 +1,272 @@
+import functools
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+from metrics import TELEGRAM_REQUEST_SECONDS
+
+SEND_PRIORITY = 0
+DELETE_PRIORITY = 1
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+
+    def wait_time(self, now):
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def is_idle(self, now):
+        return now >= self.blocked_until and self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class OutboundCall:
+
+    def __init__(self, sequence, priority, chat_id, function):
+        self.sequence = sequence
+        self.priority = priority
+        self.chat_id = chat_id
+        self.function = function
+        self.method = getattr(function, 'func', function).__name__
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class OutboundScheduler:
+    # Calls of one chat are sent one at a time in priority order. Sends and edits spend a token of the chat
+    # and of the whole bot, deletes only of the whole bot
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, workers=4):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.wait_seconds = 0
+        self.max_wait_seconds = 0
+        self.last_wait_seconds = 0
+        self._chat_buckets = {}
+        self._ready = []
+        self._delayed = []
+        self._blocked = {}
+        self._busy_chats = set()
+        self._sequence = 0
+        self._next_eviction = 0
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._workers = [
+            threading.Thread(target=self._run, name=f'outbound-{number}', daemon=True)
+            for number in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, priority, chat_id, function, wait=True):
+        with self._condition:
+            self._sequence += 1
+            call = OutboundCall(self._sequence, priority, chat_id, function)
+            heapq.heappush(self._ready, (priority, call.sequence, call))
+            self._condition.notify()
+        if wait:
+            return call.future.result()
+        return call.future
+
+    def _chat_bucket(self, chat_id):
+        if chat_id not in self._chat_buckets:
+            self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self._chat_buckets[chat_id]
+
+    def _release_delayed(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, call = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (call.priority, call.sequence, call))
+
+    def _evict_idle_buckets(self, now):
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._busy_chats and bucket.is_idle(now):
+                del self._chat_buckets[chat_id]
+
+    def _pop_ready(self, now):
+        while self._ready:
+            _, _, call = self._ready[0]
+            # A delete must not remove the old message before the reply that replaces it is sent
+            waits_for_send = call.priority != SEND_PRIORITY and any(
+                delayed_call.chat_id == call.chat_id for _, _, delayed_call in self._delayed
+            )
+            if call.chat_id in self._busy_chats or waits_for_send:
+                heapq.heappop(self._ready)
+                self._blocked.setdefault(call.chat_id, []).append(call)
+                continue
+
+            chat_bucket = self._chat_bucket(call.chat_id)
+            chat_wait = chat_bucket.wait_time(now)
+            if call.priority == SEND_PRIORITY and chat_wait:
+                heapq.heappop(self._ready)
+                heapq.heappush(self._delayed, (now + chat_wait, call.sequence, call))
+                continue
+
+            global_wait = self.global_bucket.wait_time(now)
+            if global_wait:
+                return None, global_wait
+
+            heapq.heappop(self._ready)
+            self.global_bucket.take()
+            if call.priority == SEND_PRIORITY:
+                chat_bucket.take()
+            self._busy_chats.add(call.chat_id)
+            return call, None
+        return None, None
+
+    def _next_call(self):
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                self._release_delayed(now)
+                if now >= self._next_eviction:
+                    self._evict_idle_buckets(now)
+                    self._next_eviction = now + 60
+                call, timeout = self._pop_ready(now)
+                if call:
+                    return call
+                if self._delayed:
+                    delayed_timeout = self._delayed[0][0] - now
+                    timeout = min(timeout, delayed_timeout) if timeout else delayed_timeout
+                self._condition.wait(timeout)
+        return None
+
+    def _finish_chat(self, chat_id):
+        self._busy_chats.discard(chat_id)
+        for call in self._blocked.pop(chat_id, []):
+            heapq.heappush(self._ready, (call.priority, call.sequence, call))
+        self._condition.notify_all()
+
+    def _execute(self, call):
+        started_at = time.perf_counter()
+        try:
+            return call.function()
+        finally:
+            TELEGRAM_REQUEST_SECONDS.labels(call.method).observe(time.perf_counter() - started_at)
+
+    def _run(self):
+        while True:
+            call = self._next_call()
+            if call is None:
+                return
+
+            self.last_wait_seconds = time.monotonic() - call.enqueued_at
+            self.wait_seconds += self.last_wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, self.last_wait_seconds)
+            try:
+                result = self._execute(call)
+            except RetryAfter as error:
+                self.retried += 1
+                with self._condition:
+                    now = time.monotonic()
+                    self._chat_bucket(call.chat_id).block(now, error.retry_after)
+                    heapq.heappush(self._delayed, (now + error.retry_after, call.sequence, call))
+                    self._finish_chat(call.chat_id)
+                continue
+            except Exception as error:
+                self.failed += 1
+                call.future.set_exception(error)
+                if call.priority != SEND_PRIORITY:
+                    logging.warning(f'Telegram call for chat {call.chat_id} failed: {error}')
+            else:
+                self.sent += 1
+                call.future.set_result(result)
+            with self._condition:
+                self._finish_chat(call.chat_id)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            calls = [call for _, _, call in self._ready + self._delayed]
+            calls += [call for blocked_calls in self._blocked.values() for call in blocked_calls]
+            self._ready, self._delayed, self._blocked = [], [], {}
+            self._condition.notify_all()
+        for call in calls:
+            call.future.set_exception(RuntimeError('Outbound scheduler stopped'))
+
+    def stats(self):
+        with self._condition:
+            depth = len(self._ready) + len(self._delayed) + sum(
+                len(blocked_calls) for blocked_calls in self._blocked.values()
+            )
+            chats = len(self._chat_buckets)
+        return {
+            'depth': depth,
+            'chats': chats,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'wait_seconds_total': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+            'last_wait_seconds': self.last_wait_seconds,
+        }
+
+
+class QueuedBot(ExtBot):
+    # Replies wait for their result, deletes are fire-and-forget and return a Future
+
+    def __init__(self, *args, scheduler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or OutboundScheduler()
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.scheduler.submit(
+            SEND_PRIORITY,
+            chat_id,
+            functools.partial(super().send_message, chat_id, *args, **kwargs),
+        )
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self.scheduler.submit(
+            SEND_PRIORITY,
+            chat_id,
+            functools.partial(super().send_photo, chat_id, *args, **kwargs),
+        )
+
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return self.scheduler.submit(
+            SEND_PRIORITY,
+            chat_id,
+            functools.partial(super().edit_message_text, text, chat_id, *args, **kwargs),
+        )
+
+    def edit_message_media(self, chat_id=None, *args, **kwargs):
+        return self.scheduler.submit(
+            SEND_PRIORITY,
+            chat_id,
+            functools.partial(super().edit_message_media, chat_id, *args, **kwargs),
+        )
+
+    def delete_message(self, chat_id, message_id, *args, **kwargs):
+        return self.scheduler.submit(
+            DELETE_PRIORITY,
+            chat_id,
+            functools.partial(super().delete_message, chat_id, message_id, *args, **kwargs),
+            wait=False,
+        )
@@ -0,0 +1,53 @@
+import json
+import threading
+
+
+class PhotoCache:
+
+    def __init__(self, redis_client, key='photo_file_ids'):
+        self.redis_client = redis_client
+        self.key = key
+        self.hits = 0
+        self.misses = 0
+        self._file_ids = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        cached_photos = self.redis_client.hgetall(self.key)
+        with self._lock:
+            self._file_ids = {
+                product_id: json.loads(cached_photo) for product_id, cached_photo in cached_photos.items()
+            }
+
+    def get_file_id(self, product):
+        cached_photo = self._file_ids.get(product.id)
+        if not cached_photo or cached_photo['image_url'] != product.image_url:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached_photo['file_id']
+
+    def remember(self, product, photo_message):
+        cached_photo = {
+            'image_url': product.image_url,
+            'file_id': photo_message.photo[-1].file_id,
+        }
+        if self._file_ids.get(product.id) == cached_photo:
+            return
+        with self._lock:
+            self._file_ids[product.id] = cached_photo
+        self.redis_client.hset(self.key, product.id, json.dumps(cached_photo))
+
+    def forget(self, product):
+        with self._lock:
+            self._file_ids.pop(product.id, None)
+        self.redis_client.hdel(self.key, product.id)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'photos': len(self._file_ids),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+
+from moltin_api import get_price_books, get_price_book, get_prices
+
+
+class PriceIndex:
+
+    def __init__(self, token_manager, ttl=300):
+        self.token_manager = token_manager
+        self.ttl = ttl
+        self.prices = {}
+        self.missing_skus = set()
+        self.generation = 0
+        self.loaded_at = None
+        self.refreshes = 0
+        self.last_refresh_seconds = 0
+        self._lock = threading.Lock()
+        self._invalidated = threading.Event()
+        self._stopped = threading.Event()
+
+    def _refresh(self):
+        started_at = time.monotonic()
+        access_token = self.token_manager.get_access_token()
+        price_books = get_price_books(access_token)
+        price_book = get_price_book(access_token, price_books)
+        self.prices = get_prices(price_book)
+        self.missing_skus = set()
+        self.generation += 1
+        self.loaded_at = time.time()
+        self.last_refresh_seconds = time.monotonic() - started_at
+        self.refreshes += 1
+        logging.info(f'Price index refreshed: {len(self.prices)} prices in {self.last_refresh_seconds:.3f}s')
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def get_price(self, sku):
+        price = self.prices.get(sku)
+        if price is not None:
+            return price
+        # Skus missing from the price book are not looked up again until the next refresh
+        if sku in self.missing_skus:
+            raise KeyError(sku)
+        generation = self.generation
+        with self._lock:
+            # Views that waited for the lock use the refresh another view has just made
+            if self.generation == generation:
+                self._refresh()
+            if sku not in self.prices:
+                self.missing_skus.add(sku)
+            return self.prices[sku]
+
+    def invalidate(self):
+        self._invalidated.set()
+
+    def staleness(self):
+        if self.loaded_at is None:
+            return None
+        return time.time() - self.loaded_at
+
+    def _run_refresher(self):
+        while not self._stopped.is_set():
+            self._invalidated.wait(self.ttl)
+            self._invalidated.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.refresh()
+            except Exception as error:
+                logging.warning(f'Price index refresh failed: {error}')
+
+    def start(self):
+        self.refresh()
+        thread = threading.Thread(target=self._run_refresher, name='price-index-refresher', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+        self._invalidated.set()
+
+    def stats(self):
+        return {
+            'prices': len(self.prices),
+            'missing_skus': len(self.missing_skus),
+            'refreshes': self.refreshes,
+            'last_refresh_seconds': self.last_refresh_seconds,
+            'staleness_seconds': self.staleness(),
+            'ttl_seconds': self.ttl,
+        }
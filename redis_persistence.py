@@ -0,0 +1,289 @@
+import json
+import logging
+import threading
+from collections import defaultdict
+from collections.abc import MutableMapping
+
+from telegram.ext import BasePersistence, ConversationHandler
+
+
+def encode_key(key):
+    return json.dumps(list(key))
+
+
+def decode_key(encoded_key):
+    return tuple(json.loads(encoded_key))
+
+
+def is_pending(state):
+    return isinstance(state, tuple) and len(state) == 2 and not state[1].done.is_set()
+
+
+class RedisConversations(MutableMapping):
+    # ConversationHandler keeps its states in this mapping. Pending promises of this process stay local,
+    # every other read goes to redis, so a conversation can continue on any bot instance
+
+    def __init__(self, persistence, name):
+        self.persistence = persistence
+        self.name = name
+        self.local_states = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        state = self.local_states.get(key)
+        if state is not None and is_pending(state):
+            return state
+        state = self.persistence.read_conversation(self.name, key)
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key, state):
+        # Only pending promises are kept, the persistence forgets them once their result is written
+        with self._lock:
+            if is_pending(state):
+                self.local_states[key] = state
+            else:
+                self.local_states.pop(key, None)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.local_states.pop(key, None)
+
+    def forget(self, key, state):
+        with self._lock:
+            if self.local_states.get(key) is state:
+                del self.local_states[key]
+
+    def __iter__(self):
+        return iter(self.persistence.read_conversations(self.name))
+
+    def __len__(self):
+        return len(self.persistence.read_conversations(self.name))
+
+
+class RedisPersistence(BasePersistence):
+
+    def __init__(self, redis_client, state_type, prefix='bot', flush_interval=0.2):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=True)
+        self.redis_client = redis_client
+        self.state_type = state_type
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self.coalesced_writes = 0
+        self._pending_user_data = {}
+        self._pending_conversations = defaultdict(dict)
+        self._pending_bot_data = None
+        self._saved_bot_data = None
+        self._flushing_user_data = {}
+        self._flushing_conversations = {}
+        self._conversations = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(target=self._run_flusher, name='redis-persistence', daemon=True)
+        self._flusher.start()
+
+    def insert_bot(self, obj):
+        # Stored data is plain JSON without Bot instances, skip the deep copy PTB does by default
+        return obj
+
+    def replace_bot(self, obj):
+        return obj
+
+    @property
+    def user_data_key(self):
+        return f'{self.prefix}:user_data'
+
+    @property
+    def bot_data_key(self):
+        return f'{self.prefix}:bot_data'
+
+    def conversations_key(self, name):
+        return f'{self.prefix}:conversations:{name}'
+
+    def encode_state(self, state):
+        if state is None or state == ConversationHandler.END:
+            return None
+        if isinstance(state, tuple):
+            old_state, _ = state
+            return self.encode_state(old_state)
+        return state.name
+
+    def decode_state(self, encoded_state):
+        if encoded_state is None:
+            return None
+        return self.state_type[encoded_state]
+
+    def get_user_data(self):
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        bot_data = self.redis_client.get(self.bot_data_key)
+        self._saved_bot_data = bot_data
+        return json.loads(bot_data) if bot_data else {}
+
+    def get_conversations(self, name):
+        conversations = RedisConversations(self, name)
+        self._conversations[name] = conversations
+        return conversations
+
+    def read_conversation(self, name, key):
+        encoded_key = encode_key(key)
+        with self._lock:
+            for pending_conversations in (self._pending_conversations, self._flushing_conversations):
+                if encoded_key in pending_conversations.get(name, {}):
+                    return self.decode_state(pending_conversations[name][encoded_key])
+        return self.decode_state(self.redis_client.hget(self.conversations_key(name), encoded_key))
+
+    def read_conversations(self, name):
+        conversations = {
+            decode_key(encoded_key): self.decode_state(encoded_state)
+            for encoded_key, encoded_state in self.redis_client.hgetall(self.conversations_key(name)).items()
+        }
+        with self._lock:
+            for encoded_key, encoded_state in self._pending_conversations.get(name, {}).items():
+                conversations[decode_key(encoded_key)] = self.decode_state(encoded_state)
+        return {key: state for key, state in conversations.items() if state is not None}
+
+    def update_conversation(self, name, key, new_state):
+        pending_state = None
+        if isinstance(new_state, tuple):
+            # A promise finished before the handler stored it gets no callback, its result is written now
+            if new_state[1].done.is_set():
+                new_state = self._resolve_promise(new_state)
+            else:
+                pending_state = new_state
+        with self._lock:
+            if encode_key(key) in self._pending_conversations[name]:
+                self.coalesced_writes += 1
+            self._pending_conversations[name][encode_key(key)] = self.encode_state(new_state)
+        # Registered after the old state is written, a promise finishing meanwhile runs the callback at once
+        if pending_state is not None:
+            pending_state[1].add_done_callback(lambda _: self._resolve_conversation(name, key, pending_state))
+
+    def _resolve_conversation(self, name, key, pending_state):
+        # The local promise is dropped only after its result is pending for redis, so readers never see
+        # the state from before it
+        self.update_conversation(name, key, self._resolve_promise(pending_state))
+        conversations = self._conversations.get(name)
+        if conversations is not None:
+            conversations.forget(key, pending_state)
+
+    @staticmethod
+    def _resolve_promise(state):
+        old_state, promise = state
+        try:
+            new_state = promise.result(0)
+        except Exception:
+            return old_state
+        return old_state if new_state is None else new_state
+
+    def refresh_user_data(self, user_id, user_data):
+        with self._lock:
+            encoded_user_data = self._pending_user_data.get(user_id, self._flushing_user_data.get(user_id))
+        if encoded_user_data is None:
+            encoded_user_data = self.redis_client.hget(self.user_data_key, user_id)
+        user_data.clear()
+        if encoded_user_data:
+            user_data.update(json.loads(encoded_user_data))
+
+    def update_user_data(self, user_id, data):
+        encoded_user_data = json.dumps(data)
+        with self._lock:
+            if user_id in self._pending_user_data:
+                self.coalesced_writes += 1
+            self._pending_user_data[user_id] = encoded_user_data
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        # Only plain JSON values are shared, services kept in bot_data stay local to the process
+        self._pending_bot_data = data
+
+    def _encode_bot_data(self, data):
+        shared_data = {}
+        for key, value in list(data.items()):
+            try:
+                shared_data[key] = json.loads(json.dumps(value))
+            except (TypeError, ValueError):
+                continue
+        return json.dumps(shared_data, sort_keys=True)
+
+    def flush(self):
+        with self._lock:
+            pending_user_data, self._pending_user_data = self._pending_user_data, {}
+            pending_conversations, self._pending_conversations = self._pending_conversations, defaultdict(dict)
+            pending_bot_data, self._pending_bot_data = self._pending_bot_data, None
+            # Keep the swapped out writes visible to readers until redis has them
+            self._flushing_user_data = pending_user_data
+            self._flushing_conversations = pending_conversations
+
+        encoded_bot_data = None
+        if pending_bot_data is not None:
+            encoded_bot_data = self._encode_bot_data(pending_bot_data)
+            if encoded_bot_data == self._saved_bot_data:
+                encoded_bot_data = None
+
+        try:
+            self._write(pending_user_data, pending_conversations, encoded_bot_data)
+        except Exception:
+            with self._lock:
+                for user_id, encoded_user_data in pending_user_data.items():
+                    self._pending_user_data.setdefault(user_id, encoded_user_data)
+                for name, conversations in pending_conversations.items():
+                    for encoded_key, state in conversations.items():
+                        self._pending_conversations[name].setdefault(encoded_key, state)
+                if self._pending_bot_data is None:
+                    self._pending_bot_data = pending_bot_data
+            raise
+        finally:
+            with self._lock:
+                self._flushing_user_data = {}
+                self._flushing_conversations = {}
+
+    def _write(self, pending_user_data, pending_conversations, encoded_bot_data):
+        if not pending_user_data and not pending_conversations and encoded_bot_data is None:
+            return
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        if pending_user_data:
+            pipeline.hset(self.user_data_key, mapping=pending_user_data)
+        for name, conversations in pending_conversations.items():
+            ended_keys = [encoded_key for encoded_key, state in conversations.items() if state is None]
+            states = {encoded_key: state for encoded_key, state in conversations.items() if state is not None}
+            if ended_keys:
+                pipeline.hdel(self.conversations_key(name), *ended_keys)
+            if states:
+                pipeline.hset(self.conversations_key(name), mapping=states)
+        if encoded_bot_data is not None:
+            pipeline.set(self.bot_data_key, encoded_bot_data)
+            self._saved_bot_data = encoded_bot_data
+        pipeline.execute()
+        self.flushes += 1
+
+    def _run_flusher(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as error:
+                logging.warning(f'Persistence flush failed: {error}')
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending_writes = len(self._pending_user_data) + sum(
+                len(conversations) for conversations in self._pending_conversations.values()
+            )
+        return {
+            'flushes': self.flushes,
+            'coalesced_writes': self.coalesced_writes,
+            'pending_writes': pending_writes,
+        }
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import endpoint_label
+
+RETRY_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_upstream_failure(status):
+    return status == 0 or status == 429 or status >= 500
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            # Half-open: let a single request probe the endpoint, another one once it hangs for too long
+            if self.probe_started_at is not None and now - self.probe_started_at < self.reset_timeout:
+                return False
+            self.probe_started_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info(f'Circuit breaker for {self.name} closed')
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            probe_failed = self.probe_started_at is not None
+            self.probe_started_at = None
+            if probe_failed or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    logging.warning(f'Circuit breaker for {self.name} opened after {self.failures} failures')
+                self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    # Every request deposits `ratio` of a retry, so retries add at most that share of the traffic
+    # on top of a small floor, and a flapping upstream is not hit with a retry storm
+
+    def __init__(self, ratio=0.2, min_per_second=1, max_tokens=20):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.updated_at) * self.min_per_second)
+        self.updated_at = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class ResiliencePolicy:
+    # Shared by the sync and the async client, so breakers and the retry budget see all traffic
+
+    def __init__(self, max_retries=2, backoff=0.1, max_backoff=2, deadline=8, failure_threshold=5,
+                 reset_timeout=30, retry_budget=None, stale_size=256, stale_max_bytes=16 * 1024 * 1024,
+                 stale_excluded=('/carts/', '/inventories/', '/customers')):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retry_budget = retry_budget or RetryBudget()
+        self.stale_size = stale_size
+        self.stale_max_bytes = stale_max_bytes
+        self.stale_bytes = 0
+        self.stale_excluded = stale_excluded
+        self.retries = 0
+        self.budget_exhausted = 0
+        self.short_circuited = 0
+        self.stale_served = 0
+        self._breakers = {}
+        self._stale = OrderedDict()
+        self._lock = threading.Lock()
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(endpoint, self.failure_threshold, self.reset_timeout)
+            return self._breakers[endpoint]
+
+    def _stale_key(self, method, url, params):
+        # Carts, stock and customers are never served stale: the inventory ledger treats every loaded count as
+        # fresh and a stale customer lookup could create a duplicate
+        if method != 'GET' or any(excluded in url for excluded in self.stale_excluded):
+            return None
+        return url, tuple(sorted((params or {}).items()))
+
+    def _remember(self, stale_key, result):
+        if stale_key is None:
+            return
+        # Images and catalog pages are kept too, so the copies are bounded by their size as well as their count
+        size = len(result.content) if hasattr(result, 'content') else len(result)
+        with self._lock:
+            previous = self._stale.pop(stale_key, None)
+            if previous is not None:
+                self.stale_bytes -= previous[1]
+            if size > self.stale_max_bytes:
+                return
+            self._stale[stale_key] = (result, size)
+            self.stale_bytes += size
+            while len(self._stale) > self.stale_size or self.stale_bytes > self.stale_max_bytes:
+                _, (_, evicted_size) = self._stale.popitem(last=False)
+                self.stale_bytes -= evicted_size
+
+    def _stale_or_raise(self, stale_key, error):
+        with self._lock:
+            entry = self._stale.get(stale_key) if stale_key else None
+        if entry is None:
+            raise error
+        self.stale_served += 1
+        return entry[0]
+
+    def _retry_delay(self, method, attempt, deadline_at):
+        if method not in RETRY_METHODS or attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if time.monotonic() + delay >= deadline_at:
+            return None
+        if not self.retry_budget.withdraw():
+            self.budget_exhausted += 1
+            return None
+        self.retries += 1
+        return delay
+
+    def _handle_error(self, breaker, error, error_status):
+        status = error_status(error)
+        if status is None:
+            raise error
+        if not is_upstream_failure(status):
+            breaker.record_success()
+            raise error
+        breaker.record_failure()
+
+    def call(self, method, url, send, error_status, params=None):
+        endpoint = endpoint_label(url)
+        breaker = self.breaker(endpoint)
+        stale_key = self._stale_key(method, url, params)
+        deadline_at = time.monotonic() + self.deadline
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self.short_circuited += 1
+                return self._stale_or_raise(stale_key, CircuitOpenError(f'Circuit breaker for {endpoint} is open'))
+            try:
+                result = send(deadline_at - time.monotonic())
+            except Exception as error:
+                self._handle_error(breaker, error, error_status)
+                delay = self._retry_delay(method, attempt, deadline_at)
+                if delay is None:
+                    return self._stale_or_raise(stale_key, error)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record_success()
+            self._remember(stale_key, result)
+            return result
+
+    async def call_async(self, method, url, send, error_status, params=None):
+        endpoint = endpoint_label(url)
+        breaker = self.breaker(endpoint)
+        stale_key = self._stale_key(method, url, params)
+        deadline_at = time.monotonic() + self.deadline
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self.short_circuited += 1
+                return self._stale_or_raise(stale_key, CircuitOpenError(f'Circuit breaker for {endpoint} is open'))
+            try:
+                result = await send(deadline_at - time.monotonic())
+            except Exception as error:
+                self._handle_error(breaker, error, error_status)
+                delay = self._retry_delay(method, attempt, deadline_at)
+                if delay is None:
+                    return self._stale_or_raise(stale_key, error)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record_success()
+            self._remember(stale_key, result)
+            return result
+
+    def stats(self):
+        with self._lock:
+            open_breakers = sum(breaker.is_open for breaker in self._breakers.values())
+            stale_entries = len(self._stale)
+            stale_bytes = self.stale_bytes
+        return {
+            'open_breakers': open_breakers,
+            'retries': self.retries,
+            'budget_exhausted': self.budget_exhausted,
+            'short_circuited': self.short_circuited,
+            'stale_served': self.stale_served,
+            'stale_entries': stale_entries,
+            'stale_bytes': stale_bytes,
+        }
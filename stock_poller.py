@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+
+def adapt_interval(interval, base_interval, max_interval, polled, changed, failed):
+    if not polled:
+        return interval
+    # Elasticpath is failing, so poll less
+    if failed >= polled:
+        return min(interval * 2, max_interval)
+    if changed:
+        return base_interval
+    return min(interval * 1.5, max_interval)
+
+
+class StockPoller:
+    # Keeps the stock snapshot of the inventory ledger fresh, so a product view does not wait for elasticpath.
+    # Products viewed on any bot instance within the hot window of the ledger are polled every hot_interval
+    # seconds and the rest of the catalog every interval seconds. An interval grows while its polls find
+    # no changes and drops back to the base one as soon as the stock moves
+
+    def __init__(self, ledger, bot_data, interval=60, hot_interval=5, max_interval=300, batch_size=100,
+                 concurrency=10, tick=1):
+        self.ledger = ledger
+        self.redis_client = ledger.redis_client
+        self.bot_data = bot_data
+        self.base_interval = interval
+        self.base_hot_interval = hot_interval
+        # Both intervals have to stay within the staleness bounds of the handlers
+        self.max_interval = max(interval, max_interval)
+        if ledger.cold_max_age:
+            self.max_interval = max(interval, min(self.max_interval, ledger.cold_max_age / 2))
+        if ledger.max_age:
+            self.max_hot_interval = max(hot_interval, ledger.max_age / 2)
+        else:
+            self.max_hot_interval = self.max_interval
+        self.hot_window = ledger.hot_window
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.tick = tick
+        self.interval = interval
+        self.hot_interval = hot_interval
+        self.polls = 0
+        self.polled_products = 0
+        self.changed_products = 0
+        self.failed_products = 0
+        self.hot_products = 0
+        self.due_products = 0
+        self.unchecked_products = 0
+        self.oldest_check_seconds = 0
+        self.last_poll_seconds = 0
+        self._stopped = threading.Event()
+
+    def get_due_products(self, now):
+        product_ids = list(self.bot_data['catalog'].by_id)
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.zremrangebyscore(self.ledger.viewed_key, '-inf', now - self.hot_window)
+        pipeline.zrange(self.ledger.viewed_key, 0, -1)
+        pipeline.hgetall(self.ledger.checked_at_key)
+        _, viewed, checked_at = pipeline.execute()
+        viewed = set(viewed)
+
+        hot_due = []
+        cold_due = []
+        unchecked = 0
+        oldest_check = 0
+        for product_id in product_ids:
+            if product_id in checked_at:
+                age = now - float(checked_at[product_id])
+                oldest_check = max(oldest_check, age)
+            else:
+                age = now
+                unchecked += 1
+            if product_id in viewed:
+                if age >= self.hot_interval:
+                    hot_due.append((age, product_id))
+            elif age >= self.interval:
+                cold_due.append((age, product_id))
+        self.hot_products = len(viewed)
+        self.due_products = len(hot_due) + len(cold_due)
+        self.unchecked_products = unchecked
+        self.oldest_check_seconds = oldest_check
+
+        # Viewed products go first, then the ones checked longest ago
+        hot_due.sort(reverse=True)
+        cold_due.sort(reverse=True)
+        hot_ids = [product_id for _, product_id in hot_due[:self.batch_size]]
+        cold_ids = [product_id for _, product_id in cold_due[:self.batch_size - len(hot_ids)]]
+        return hot_ids, cold_ids
+
+    def poll(self, poll_lock=None):
+        started_at = time.monotonic()
+        hot_ids, cold_ids = self.get_due_products(time.time())
+        if not hot_ids and not cold_ids:
+            return
+
+        # A whole batch can outlast the lock timeout, so the lock is renewed before every chunk of
+        # concurrent requests. Once it expired, reacquire raises and the poll stops before a flush overlaps it
+        product_ids = hot_ids + cold_ids
+        changed = set()
+        failed = set()
+        for chunk_start in range(0, len(product_ids), self.concurrency):
+            if poll_lock is not None:
+                poll_lock.reacquire()
+            chunk_changed, chunk_failed = self.ledger.reconcile(
+                product_ids[chunk_start:chunk_start + self.concurrency],
+                self.concurrency,
+            )
+            changed |= chunk_changed
+            failed |= chunk_failed
+        self.hot_interval = adapt_interval(
+            self.hot_interval,
+            self.base_hot_interval,
+            self.max_hot_interval,
+            len(hot_ids),
+            len(changed.intersection(hot_ids)),
+            len(failed.intersection(hot_ids)),
+        )
+        self.interval = adapt_interval(
+            self.interval,
+            self.base_interval,
+            self.max_interval,
+            len(cold_ids),
+            len(changed.intersection(cold_ids)),
+            len(failed.intersection(cold_ids)),
+        )
+        self.polls += 1
+        self.polled_products += len(hot_ids) + len(cold_ids)
+        self.changed_products += len(changed)
+        self.failed_products += len(failed)
+        self.last_poll_seconds = time.monotonic() - started_at
+
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            # Only one bot instance polls, and never while the ledger sends its transactions
+            poll_lock = self.ledger.lock()
+            if not poll_lock.acquire(blocking=False):
+                continue
+            try:
+                self.poll(poll_lock)
+            except Exception as error:
+                logging.warning(f'Stock poll failed: {error}')
+            finally:
+                self.ledger.release_lock(poll_lock)
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='stock-poller', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        return {
+            'polls': self.polls,
+            'polled_products': self.polled_products,
+            'changed_products': self.changed_products,
+            'failed_products': self.failed_products,
+            'hot_products': self.hot_products,
+            'due_products': self.due_products,
+            'unchecked_products': self.unchecked_products,
+            'interval_seconds': self.interval,
+            'hot_interval_seconds': self.hot_interval,
+            'oldest_check_seconds': self.oldest_check_seconds,
+            'last_poll_seconds': self.last_poll_seconds,
+        }
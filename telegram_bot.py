@@ -1,35 +1,107 @@
 import logging
+import queue
+import sys
+import threading
 from enum import Enum
 
 import redis
-import telegram
 from environs import Env
 from requests import HTTPError
-from telegram.ext import Updater, ConversationHandler, CommandHandler, CallbackQueryHandler, MessageHandler, Filters
+from telegram.error import BadRequest
+from telegram.ext import Updater, ConversationHandler, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, \
+    DispatcherHandlerStop, Defaults
+from telegram.utils.request import Request
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, ReplyKeyboardMarkup, \
-    KeyboardButton
+    KeyboardButton, InputMediaPhoto
 from email_validate import validate
 
-from moltin_api import get_products, get_access_token, \
-    get_product_quantity, get_price_books, get_price_book, get_prices, get_image, add_to_cart, delete_from_cart, \
-    update_product_quantity, get_cart_items, update_customer, create_customer
+from cart_cache import CartCache
+from catalog import Catalog
+from catalog_refresher import CatalogRefresher
+from customer_store import CustomerStore
+from dispatching import BoundedDispatcher, BoundedUpdateQueue
+from inventory_ledger import InventoryLedger
+from metrics import bot_handler, start_metrics_server
+from order_queue import OrderQueue
+from outbound import OutboundScheduler, QueuedBot
+import moltin_async
+from async_handlers import load_product_image, load_stock_and_image, purchase_product, load_cart, remove_product
+from moltin_api import AccessTokenManager, ApiClient, API_URL, configure_client, iter_product_pages
+from photo_cache import PhotoCache
+from price_index import PriceIndex
+from stock_poller import StockPoller
+from redis_persistence import RedisPersistence
+from resilience import ResiliencePolicy
 
 logger = logging.getLogger('bot_logger')
 
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 
 class BotLogsHandler(logging.Handler):
 
-    def __init__(self, bot, admin_chat_id):
+    def __init__(self, bot, admin_chat_id, flush_interval=5, max_queue_size=1000):
         self.bot = bot
         self.admin_chat_id = admin_chat_id
+        self.flush_interval = flush_interval
+        self.log_entries = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+        self._stopped = threading.Event()
         super().__init__()
+        self._sender = threading.Thread(target=self._run, name='bot-logs-sender', daemon=True)
+        self._sender.start()
 
     def emit(self, record):
-        log_entry = self.format(record)
-        self.bot.send_message(
-            chat_id=self.admin_chat_id,
-            text=log_entry,
-        )
+        try:
+            self.log_entries.put_nowait((record.levelname, record.getMessage(), self.format(record)))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _collect_batch(self):
+        batch = {}
+        while True:
+            try:
+                level, message, log_entry = self.log_entries.get_nowait()
+            except queue.Empty:
+                break
+            if (level, message) in batch:
+                batch[(level, message)][1] += 1
+            else:
+                batch[(level, message)] = [log_entry, 1]
+
+        lines = [
+            log_entry if count == 1 else f'{log_entry} (x{count})'
+            for log_entry, count in batch.values()
+        ]
+        if self.dropped:
+            lines.append(f'{self.dropped} log records dropped')
+            self.dropped = 0
+        return '\n'.join(lines)
+
+    def _send(self, text):
+        for chunk_start in range(0, len(text), TELEGRAM_MESSAGE_LIMIT):
+            chunk = text[chunk_start:chunk_start + TELEGRAM_MESSAGE_LIMIT]
+            self.bot.send_message(chat_id=self.admin_chat_id, text=chunk)
+
+    def flush(self):
+        text = self._collect_batch()
+        if not text:
+            return
+        try:
+            self._send(text)
+        except Exception as error:
+            print(f'Failed to send logs to the admin chat: {error}', file=sys.stderr)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+        super().close()
 
 
 class State(Enum):
@@ -76,6 +148,128 @@ def get_inline_keyboard(buttons, cols_quantity):
     return reply_markup
 
 
+def get_catalog_keyboard(catalog):
+    if catalog.keyboard is not None:
+        return catalog.keyboard
+    # While pages are still loading the keyboard shows the products loaded so far and is not kept,
+    # otherwise it could overwrite the reset done by a page added meanwhile
+    loaded = catalog.loaded
+    keyboard_buttons = []
+    for product in list(catalog):
+        keyboard_buttons.append(
+            {
+                'name': product.name,
+                'data': product.id
+            }
+        )
+    keyboard_buttons.append(CART_BUTTON)
+    keyboard = get_inline_keyboard(keyboard_buttons, 2)
+    if loaded:
+        catalog.keyboard = keyboard
+    return keyboard
+
+
+def get_stock_tier(products_quantity):
+    if products_quantity <= 0:
+        return 0
+    if products_quantity < 5:
+        return 1
+    if products_quantity < 10:
+        return 2
+    return 3
+
+
+def get_product_card(catalog, product, price, products_quantity):
+    # Only the stock line differs between views of the same product, price and stock tier, so the rest of
+    # the caption and the keyboard are built once. The keyboard is kept as JSON, the way it goes to Telegram
+    stock_tier = get_stock_tier(products_quantity)
+    card_key = (product.id, price.amount, stock_tier)
+    card = catalog.product_cards.get(card_key)
+    if card is None:
+        keyboard_buttons = [
+            {
+                'name': f'{quantity} кг',
+                'data': f'{quantity} {product.id}'
+            }
+            for quantity in (1, 5, 10)[:stock_tier]
+        ]
+        keyboard_buttons.append(SHOP_BACK_BUTTON)
+        keyboard_buttons.append(CART_BUTTON)
+        card = (
+            f'{product.name}\n\n${price.amount} за кг\n\n',
+            f'\n\n{product.description}',
+            get_inline_keyboard(keyboard_buttons, 3).to_json(),
+        )
+        catalog.product_cards[card_key] = card
+
+    caption_head, caption_tail, reply_markup = card
+    if stock_tier == 0:
+        stock_message = 'К сожалению, данный товар закончился'
+    else:
+        stock_message = f'{products_quantity} кг на складе'
+    return f'{caption_head}{stock_message}{caption_tail}', reply_markup
+
+
+def run_api(context, coroutine):
+    return context.bot_data['event_loop'].run(coroutine)
+
+
+def show_text(context, chat_id, old_message, text, reply_markup):
+    if old_message is not None and not old_message.photo:
+        try:
+            return context.bot.edit_message_text(
+                text=text,
+                chat_id=chat_id,
+                message_id=old_message.message_id,
+                reply_markup=reply_markup
+            )
+        except BadRequest as error:
+            if 'message is not modified' in error.message.lower():
+                return old_message
+
+    new_message = context.bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        reply_markup=reply_markup
+    )
+    if old_message is not None:
+        context.bot.delete_message(chat_id, old_message.message_id)
+    return new_message
+
+
+def is_file_id_error(error):
+    message = error.message.lower()
+    return 'file identifier' in message or 'file_id' in message
+
+
+def show_photo(context, chat_id, old_message, photo, caption, reply_markup):
+    if old_message is not None and old_message.photo:
+        try:
+            return context.bot.edit_message_media(
+                chat_id=chat_id,
+                message_id=old_message.message_id,
+                media=InputMediaPhoto(photo, caption=caption),
+                reply_markup=reply_markup
+            )
+        except BadRequest as error:
+            if 'message is not modified' in error.message.lower():
+                return old_message
+            # A new message would fail on the same file id, the caller loads the image instead
+            if is_file_id_error(error):
+                raise
+
+    new_message = context.bot.send_photo(
+        chat_id=chat_id,
+        photo=photo,
+        caption=caption,
+        reply_markup=reply_markup
+    )
+    if old_message is not None:
+        context.bot.delete_message(chat_id, old_message.message_id)
+    return new_message
+
+
+@bot_handler
 def start(update, context):
     message = 'Здравствуйте! Я бот для продажи свежайшей рыбы!'
     update.message.reply_text(
@@ -86,189 +280,158 @@ def start(update, context):
     return State.PRODUCTS_SENT
 
 
+@bot_handler
 def send_products(update, context):
     query = update.callback_query
     chat_id = update.effective_chat.id
 
-    products = context.bot_data['products']
-    keyboard_buttons = []
-    for product in products:
-        keyboard_buttons.append(
-            {
-                'name': product['name'],
-                'data': product['id']
-            }
-        )
-
-    keyboard_buttons.append(CART_BUTTON)
     message = 'Выберите продукт:'
-    reply_markup = get_inline_keyboard(keyboard_buttons, 2)
-
-    context.bot.send_message(
-        chat_id=chat_id,
-        text=message,
-        reply_markup=reply_markup
-    )
-
-    if query:
-        message_id = query.message.message_id
-        context.bot.delete_message(chat_id, message_id)
+    reply_markup = get_catalog_keyboard(context.bot_data['catalog'])
+    show_text(context, chat_id, query.message if query else None, message, reply_markup)
 
     return State.PRODUCTS_SENT
 
 
+@bot_handler
 def handle_product(update, context):
-    redis_client = context.bot_data['redis_client']
-    access_token = get_access_token(redis_client)
+    access_token = context.bot_data['token_manager'].get_access_token()
     query = update.callback_query
-    message_id = query.message.message_id
     chat_id = update.effective_chat.id
     product_id = query.data
-    products_quantity = get_product_quantity(access_token, product_id)
-
-    keyboard_buttons = []
+    photo_cache = context.bot_data['photo_cache']
+    price_index = context.bot_data['price_index']
+
+    current_product = context.bot_data['catalog'].get(product_id)
+
+    inventory = context.bot_data['inventory']
+    products_quantity, is_fresh = inventory.read_snapshot(product_id)
+    photo = photo_cache.get_file_id(current_product)
+    if not is_fresh and not photo:
+        # Both missed, so the stock and the image are loaded in one trip to the event loop
+        generation = inventory.get_generation()
+        remote_quantity, photo = run_api(context, load_stock_and_image(access_token, current_product))
+        products_quantity = inventory.store_load(product_id, products_quantity, remote_quantity, generation)
+    else:
+        if not is_fresh:
+            products_quantity = inventory.refresh(product_id, products_quantity)
+        if not photo:
+            photo = run_api(context, load_product_image(access_token, current_product))
 
-    if products_quantity == 0:
-        stock_message = 'К сожалению, данный товар закончился'
+    price = price_index.get_price(current_product.sku)
+    message, reply_markup = get_product_card(context.bot_data['catalog'], current_product, price, products_quantity)
+    send_product_photo(context, chat_id, query.message, current_product, photo, message, reply_markup)
 
-    else:
-        keyboard_buttons = [
-            {
-                'name': '1 кг',
-                'data': f'1 {product_id}'
-            }
-        ]
-        stock_message = f'{products_quantity} кг на складе'
+    return State.PRODUCT_HANDLED
 
-    if products_quantity >= 5:
-        keyboard_buttons.append(
-            {
-                'name': '5 кг',
-                'data': f'5 {product_id}'
-            }
-        )
-    if products_quantity >= 10:
-        keyboard_buttons.append(
-            {
-                'name': '10 кг',
-                'data': f'10 {product_id}'
-            }
-        )
 
-    keyboard_buttons.append(SHOP_BACK_BUTTON)
-    keyboard_buttons.append(CART_BUTTON)
-    price_books = get_price_books(access_token)
-    price_book = get_price_book(access_token, price_books)
-    prices = get_prices(price_book)
-
-    products = context.bot_data['products']
-
-    for product in products:
-        if product['id'] == product_id:
-            message = (
-                f'{product["name"]}\n\n'
-                f'${prices[product["sku"]]} за кг\n\n'
-                f'{stock_message}\n\n'
-                f'{product["description"]}'
-            )
-            current_product = product
+def send_product_photo(context, chat_id, old_message, product, photo, caption, reply_markup):
+    photo_cache = context.bot_data['photo_cache']
+    if isinstance(photo, str):
+        try:
+            return show_photo(context, chat_id, old_message, photo, caption, reply_markup)
+        except BadRequest as error:
+            if not is_file_id_error(error):
+                raise
+            photo_cache.forget(product)
+            access_token = context.bot_data['token_manager'].get_access_token()
+            photo = run_api(context, moltin_async.get_image(access_token, product))
 
-    reply_markup = get_inline_keyboard(keyboard_buttons, 3)
-    image = get_image(access_token, current_product)
+    photo_message = show_photo(context, chat_id, old_message, photo, caption, reply_markup)
+    photo_cache.remember(product, photo_message)
+    return photo_message
 
-    context.bot.send_photo(
-        chat_id=chat_id,
-        photo=image,
-        caption=message,
-        reply_markup=reply_markup
-    )
-    context.bot.delete_message(chat_id, message_id)
 
-    return State.PRODUCT_HANDLED
+def update_cart(context, chat_id, coroutine):
+    cart_cache = context.bot_data['cart_cache']
+    try:
+        cart = run_api(context, coroutine)
+    except Exception:
+        cart_cache.invalidate(chat_id)
+        raise
+    cart_cache.put(chat_id, cart)
+    return cart
 
 
+@bot_handler
 def handle_purchase(update, context):
-    redis_client = context.bot_data['redis_client']
-    access_token = get_access_token(redis_client)
+    access_token = context.bot_data['token_manager'].get_access_token()
     query = update.callback_query
     chat_id = update.effective_chat.id
-    message_id = query.message.message_id
     product_quantity, product_id = query.data.split(' ')
-    cart = add_to_cart(access_token, product_id, product_quantity, chat_id)
-    update_product_quantity(access_token, product_id, product_quantity, 'allocate')
-    display_cart(cart, message_id, chat_id, context)
+    inventory = context.bot_data['inventory']
+    if not inventory.reserve(product_id, product_quantity, fresh=True):
+        query.answer('К сожалению, на складе не хватает этого товара', show_alert=True)
+        return State.PRODUCT_HANDLED
+
+    try:
+        cart = update_cart(context, chat_id, purchase_product(access_token, product_id, product_quantity, chat_id))
+    except Exception:
+        inventory.release(product_id, product_quantity)
+        raise
+    display_cart(cart, query.message, chat_id, context)
 
     return State.PURCHASE_HANDLED
 
 
+@bot_handler
 def handle_cart(update, context):
-    redis_client = context.bot_data['redis_client']
-    access_token = get_access_token(redis_client)
+    access_token = context.bot_data['token_manager'].get_access_token()
     query = update.callback_query
     chat_id = update.effective_chat.id
-    message_id = query.message.message_id
-    cart = get_cart_items(access_token, chat_id)
-    display_cart(cart, message_id, chat_id, context)
+    cart_cache = context.bot_data['cart_cache']
+    cart = cart_cache.get(chat_id)
+    if cart is None:
+        cart = update_cart(context, chat_id, load_cart(access_token, chat_id))
+    display_cart(cart, query.message, chat_id, context)
 
     return State.PURCHASE_HANDLED
 
 
+@bot_handler
 def handle_removal(update, context):
-    redis_client = context.bot_data['redis_client']
-    access_token = get_access_token(redis_client)
+    access_token = context.bot_data['token_manager'].get_access_token()
     query = update.callback_query
     chat_id = update.effective_chat.id
-    message_id = query.message.message_id
 
     product_quantity, product_id = query.data.split(' ')
     cart_item_id = context.user_data[product_id]
-    cart = delete_from_cart(access_token, cart_item_id, chat_id)
-    update_product_quantity(access_token, product_id, product_quantity, 'deallocate')
-    display_cart(cart, message_id, chat_id, context)
+    cart = update_cart(context, chat_id, remove_product(access_token, cart_item_id, chat_id))
+    context.bot_data['inventory'].release(product_id, product_quantity)
+    display_cart(cart, query.message, chat_id, context)
 
     return State.PURCHASE_HANDLED
 
 
-def display_cart(cart, message_id,  chat_id, context):
+def display_cart(cart, old_message, chat_id, context):
     keyboard_buttons = []
     message = 'Ваши продукты:\n\n'
-    total_price = 0
-    for product in cart['data']:
-        product_name = product["name"]
-        product_quantity = product["quantity"]
-        product_id = product["product_id"]
-        product_cost = product["meta"]["display_price"]["without_discount"]["value"]["amount"] / 100
-        total_price += product_cost
+    for cart_item in cart.items:
         message += (
-            f'{product_name}\n' 
-            f'{product_quantity} кг в корзине на '
-            f'${product_cost}\n\n'
+            f'{cart_item.name}\n' 
+            f'{cart_item.quantity} кг в корзине на '
+            f'${cart_item.cost}\n\n'
         )
         keyboard_buttons.append(
             {
-                'name': f'Удалить из корзины {product_name}',
-                'data': f'{product_quantity} {product_id}'
+                'name': f'Удалить из корзины {cart_item.name}',
+                'data': f'{cart_item.quantity} {cart_item.product_id}'
             }
         )
-        context.user_data[product_id] = product["id"]
-    message += f'Всего: ${total_price}'
-    if total_price > 0:
+        context.user_data[cart_item.product_id] = cart_item.id
+    message += f'Всего: ${cart.total}'
+    if cart.total > 0:
         keyboard_buttons.append(PAYMENT_BUTTON)
     keyboard_buttons.append(SHOP_BACK_BUTTON)
     reply_markup = get_inline_keyboard(keyboard_buttons, 1)
-    context.bot.send_message(
-        chat_id=chat_id,
-        text=message,
-        reply_markup=reply_markup
-    )
-    context.bot.delete_message(chat_id, message_id)
+    show_text(context, chat_id, old_message, message, reply_markup)
 
 
+@bot_handler
 def handle_registration(update, context):
-    redis_client = context.bot_data['redis_client']
+    customers = context.bot_data['customers']
     query = update.callback_query
     chat_id = update.effective_chat.id
-    customer_id = redis_client.get(f'id {chat_id}')
+    customer_id = customers.get_customer_id(chat_id)
     if customer_id:
         message = 'Вы авторизованы. Желаете изменить данные или оформить заказ?'
         keyboard_buttons = [
@@ -293,6 +456,7 @@ def handle_registration(update, context):
         return proceed_registration(update, context)
 
 
+@bot_handler
 def proceed_registration(update, context):
     query = update.callback_query
     user = query.from_user
@@ -324,6 +488,7 @@ def proceed_registration(update, context):
     return State.ASKED_NAME
 
 
+@bot_handler
 def handle_order(update, context):
     query = update.callback_query
     message = 'Спасибо! Ваш заказ оформлен. Скоро с Вами свяжется менеджер.'
@@ -336,6 +501,7 @@ def handle_order(update, context):
     return State.ORDER_REGISTERED
 
 
+@bot_handler
 def handle_accepted_name(update, context):
     query = update.callback_query
     message = 'Пришлите мне почту для связи'
@@ -345,6 +511,7 @@ def handle_accepted_name(update, context):
     return State.EMAIL_REQUESTED
 
 
+@bot_handler
 def handle_rejected_user_name(update, context):
     query = update.callback_query
     query.edit_message_text(
@@ -353,6 +520,7 @@ def handle_rejected_user_name(update, context):
     return State.NAME_REQUESTED
 
 
+@bot_handler
 def handle_new_name(update, context):
     user_name = update.message.text
     context.user_data['user_name'] = user_name
@@ -364,6 +532,7 @@ def handle_new_name(update, context):
     return State.EMAIL_REQUESTED
 
 
+@bot_handler
 def handle_email(update, context):
     email = update.message.text
     if validate(email):
@@ -388,6 +557,7 @@ def handle_email(update, context):
         return State.EMAIL_REQUESTED
 
 
+@bot_handler
 def handle_phone_number_text(update, context):
     message = 'Пожалуйста, воспользуйтесь кнопкой для передачи контакта'
     reply_markup = ReplyKeyboardMarkup(
@@ -401,23 +571,14 @@ def handle_phone_number_text(update, context):
     return State.PHONE_NUMBER_REQUESTED
 
 
+@bot_handler
 def handle_contact(update, context):
-    redis_client = context.bot_data['redis_client']
-    access_token = get_access_token(redis_client)
     chat_id = update.effective_chat.id
     phone_number = update.message.contact.phone_number
     user_name = context.user_data['user_name']
     email = context.user_data['email']
 
-    customer_id = redis_client.get(f'id {chat_id}')
-    if customer_id:
-        customer = update_customer(access_token, user_name, phone_number, email, customer_id)
-    else:
-        customer = create_customer(access_token, user_name, phone_number, email)
-
-    customer_id = customer['data']['id']
-
-    redis_client.set(f'id {chat_id}', customer_id)
+    context.bot_data['orders'].submit(chat_id, user_name, phone_number, email)
 
     request_message_id = context.user_data['request_message_id']
 
@@ -433,10 +594,206 @@ def handle_contact(update, context):
     return State.ORDER_REGISTERED
 
 
+def reload_catalog(update, context):
+    context.bot_data['catalog_refresher'].trigger()
+    update.message.reply_text('Каталог обновляется')
+    raise DispatcherHandlerStop
+
+
 def error_handler(update, context):
     logger.error(context.error)
 
 
+def create_conversation_handler(persistent=False):
+    conversation_handler = ConversationHandler(
+        name='fish_shop',
+        persistent=persistent,
+        per_chat=False,
+        entry_points=[CommandHandler('start', start)],
+        states={
+            State.PRODUCTS_SENT: [
+                CallbackQueryHandler(
+                    handle_cart,
+                    pattern='go_to_cart'
+                ),
+                CallbackQueryHandler(
+                    handle_product
+                )
+            ],
+            State.PRODUCT_HANDLED: [
+                CallbackQueryHandler(
+                    send_products,
+                    pattern='back_to_menu'
+                ),
+                CallbackQueryHandler(
+                    handle_cart,
+                    pattern='go_to_cart'
+                ),
+                CallbackQueryHandler(
+                    handle_purchase
+                )
+            ],
+            State.PURCHASE_HANDLED: [
+                CallbackQueryHandler(
+                    send_products,
+                    pattern='back_to_menu'
+                ),
+                CallbackQueryHandler(
+                    handle_registration,
+                    pattern='go_to_payment'
+                ),
+                CallbackQueryHandler(
+                    handle_removal
+                )
+            ],
+            State.REGISTRATION_REQUESTED: [
+                CallbackQueryHandler(
+                    proceed_registration,
+                    pattern='change_data'
+                ),
+                CallbackQueryHandler(
+                    handle_order,
+                    pattern='arrange_order'
+                ),
+            ],
+            State.ASKED_NAME: [
+                CallbackQueryHandler(
+                    handle_accepted_name,
+                    pattern='name_accepted'
+                ),
+                CallbackQueryHandler(
+                    handle_rejected_user_name,
+                    pattern='name_rejected'
+                ),
+            ],
+            State.NAME_REQUESTED: [
+                MessageHandler(
+                    Filters.text,
+                    handle_new_name
+                )
+            ],
+            State.EMAIL_REQUESTED: [
+                MessageHandler(
+                    Filters.text,
+                    handle_email
+                )
+            ],
+            State.PHONE_NUMBER_REQUESTED: [
+                MessageHandler(
+                    Filters.text,
+                    handle_phone_number_text
+                ),
+                MessageHandler(
+                    Filters.contact,
+                    handle_contact
+                ),
+            ],
+            State.ORDER_REGISTERED: [
+                CallbackQueryHandler(
+                    send_products
+                )
+            ],
+        },
+        fallbacks=[
+            CommandHandler('start', start)
+        ]
+    )
+    return conversation_handler
+
+
+def setup_dispatcher(env, dispatcher, redis_client, client_id, client_secret, admin_chat_id):
+    token_manager = AccessTokenManager(
+        redis_client,
+        client_id,
+        client_secret,
+        refresh_margin=env.int('TOKEN_REFRESH_MARGIN', 60),
+    )
+    token_manager.start()
+    event_loop = moltin_async.EventLoopThread()
+    event_loop.start()
+
+    product_pages = iter_product_pages(
+        token_manager.get_access_token(),
+        page_limit=env.int('CATALOG_PAGE_SIZE', 100),
+    )
+    catalog = Catalog(next(product_pages, []))
+    catalog.load_in_background(product_pages)
+    price_index = PriceIndex(token_manager, ttl=env.int('PRICES_TTL', 300))
+    price_index.start()
+    photo_cache = PhotoCache(redis_client)
+    photo_cache.load()
+    cart_cache = CartCache(
+        redis_client if dispatcher.persistence is not None else None,
+        ttl=env.int('CART_CACHE_TTL', 300),
+    )
+
+    dispatcher.bot_data['catalog'] = catalog
+    dispatcher.bot_data['event_loop'] = event_loop
+    dispatcher.bot_data['redis_client'] = redis_client
+    dispatcher.bot_data['token_manager'] = token_manager
+    dispatcher.bot_data['price_index'] = price_index
+    dispatcher.bot_data['photo_cache'] = photo_cache
+    dispatcher.bot_data['cart_cache'] = cart_cache
+    customers = CustomerStore(redis_client, cache_size=env.int('CUSTOMER_CACHE_SIZE', 10000))
+    dispatcher.bot_data['customers'] = customers
+
+    inventory = InventoryLedger(
+        redis_client,
+        token_manager,
+        event_loop,
+        flush_interval=env.float('INVENTORY_FLUSH_INTERVAL', 2),
+        max_age=env.float('STOCK_MAX_AGE', 30),
+        cold_max_age=env.float('STOCK_COLD_MAX_AGE', 600),
+        hot_window=env.int('STOCK_HOT_WINDOW', 300),
+    )
+    inventory.start()
+    dispatcher.bot_data['inventory'] = inventory
+    stock_poller = StockPoller(
+        inventory,
+        dispatcher.bot_data,
+        interval=env.float('STOCK_POLL_INTERVAL', 60),
+        hot_interval=env.float('STOCK_HOT_POLL_INTERVAL', 5),
+        max_interval=env.float('STOCK_MAX_POLL_INTERVAL', 300),
+        batch_size=env.int('STOCK_POLL_BATCH', 100),
+    )
+    stock_poller.start()
+    dispatcher.bot_data['stock_poller'] = stock_poller
+
+    orders = OrderQueue(
+        redis_client,
+        token_manager,
+        event_loop,
+        customers,
+        workers=env.int('ORDER_WORKERS', 2),
+        max_attempts=env.int('ORDER_MAX_ATTEMPTS', 5),
+        retry_delay=env.float('ORDER_RETRY_DELAY', 10),
+    )
+    orders.start()
+    dispatcher.bot_data['orders'] = orders
+
+    catalog_refresher = CatalogRefresher(
+        dispatcher.bot_data,
+        token_manager,
+        price_index,
+        interval=env.int('CATALOG_REFRESH_INTERVAL', 600),
+        page_limit=env.int('CATALOG_PAGE_SIZE', 100),
+    )
+    catalog_refresher.start()
+    dispatcher.bot_data['catalog_refresher'] = catalog_refresher
+
+    dispatcher.add_handler(
+        CommandHandler(
+            'reload_catalog',
+            reload_catalog,
+            filters=Filters.chat(chat_id=int(admin_chat_id)),
+            run_async=False
+        ),
+        group=-1
+    )
+    dispatcher.add_handler(create_conversation_handler(persistent=dispatcher.persistence is not None))
+    dispatcher.add_error_handler(error_handler, run_async=False)
+
+
 def main():
     env = Env()
     env.read_env()
@@ -449,6 +806,30 @@ def main():
     client_id = env('CLIENT_ID')
     client_secret = env('CLIENT_SECRET')
 
+    api_policy = ResiliencePolicy(
+        max_retries=env.int('MOLTIN_RETRIES', 2),
+        deadline=env.float('MOLTIN_DEADLINE', 8),
+        failure_threshold=env.int('MOLTIN_BREAKER_THRESHOLD', 5),
+        reset_timeout=env.float('MOLTIN_BREAKER_RESET_TIMEOUT', 30),
+        stale_max_bytes=env.int('MOLTIN_STALE_MAX_MB', 16) * 1024 * 1024,
+    )
+    configure_client(
+        ApiClient(
+            base_url=env('MOLTIN_API_URL', API_URL),
+            timeout=(env.float('MOLTIN_CONNECT_TIMEOUT', 3.05), env.float('MOLTIN_READ_TIMEOUT', 10)),
+            pool_maxsize=env.int('MOLTIN_POOL_SIZE', 16),
+            policy=api_policy,
+        )
+    )
+    moltin_async.configure_client(
+        moltin_async.AsyncApiClient(
+            base_url=env('MOLTIN_API_URL', API_URL),
+            timeout=(env.float('MOLTIN_CONNECT_TIMEOUT', 3.05), env.float('MOLTIN_READ_TIMEOUT', 10)),
+            pool_size=env.int('MOLTIN_ASYNC_POOL_SIZE', 100),
+            policy=api_policy,
+        )
+    )
+
     redis_client = redis.Redis(
         host=host,
         port=port,
@@ -456,14 +837,22 @@ def main():
         decode_responses=True
     )
 
-    redis_client.set('client_id', client_id)
-    redis_client.set('client_secret', client_secret)
-    access_token = get_access_token(redis_client)
-
-    bot = telegram.Bot(token=bot_token)
+    workers = env.int('WORKERS', 8)
+    outbound_workers = env.int('OUTBOUND_WORKERS', 4)
+    bot = QueuedBot(
+        token=bot_token,
+        request=Request(con_pool_size=workers + outbound_workers + 4),
+        defaults=Defaults(run_async=True),
+        scheduler=OutboundScheduler(
+            global_rate=env.float('TELEGRAM_GLOBAL_RATE', 30),
+            chat_rate=env.float('TELEGRAM_CHAT_RATE', 1),
+            chat_burst=env.int('TELEGRAM_CHAT_BURST', 3),
+            workers=outbound_workers,
+        ),
+    )
 
     logger.setLevel(logging.INFO)
-    log_handler = BotLogsHandler(bot, admin_chat_id)
+    log_handler = BotLogsHandler(bot, admin_chat_id, flush_interval=env.int('ADMIN_LOGS_INTERVAL', 5))
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     log_handler.setFormatter(formatter)
     log_handler.setLevel(logging.INFO)
@@ -471,109 +860,60 @@ def main():
     logger.addHandler(log_handler)
 
     try:
-        products = get_products(access_token)
-
-        updater = Updater(token=bot_token, use_context=True)
-        dispatcher = updater.dispatcher
-        dispatcher.bot_data['products'] = products
-        dispatcher.bot_data['redis_client'] = redis_client
-
-        conversation_handler = ConversationHandler(
-            per_chat=False,
-            entry_points=[CommandHandler('start', start)],
-            states={
-                State.PRODUCTS_SENT: [
-                    CallbackQueryHandler(
-                        handle_cart,
-                        pattern='go_to_cart'
-                    ),
-                    CallbackQueryHandler(
-                        handle_product
-                    )
-                ],
-                State.PRODUCT_HANDLED: [
-                    CallbackQueryHandler(
-                        send_products,
-                        pattern='back_to_menu'
-                    ),
-                    CallbackQueryHandler(
-                        handle_cart,
-                        pattern='go_to_cart'
-                    ),
-                    CallbackQueryHandler(
-                        handle_purchase
-                    )
-                ],
-                State.PURCHASE_HANDLED: [
-                    CallbackQueryHandler(
-                        send_products,
-                        pattern='back_to_menu'
-                    ),
-                    CallbackQueryHandler(
-                        handle_registration,
-                        pattern='go_to_payment'
-                    ),
-                    CallbackQueryHandler(
-                        handle_removal
-                    )
-                ],
-                State.REGISTRATION_REQUESTED: [
-                    CallbackQueryHandler(
-                        proceed_registration,
-                        pattern='change_data'
-                    ),
-                    CallbackQueryHandler(
-                        handle_order,
-                        pattern='arrange_order'
-                    ),
-                ],
-                State.ASKED_NAME: [
-                    CallbackQueryHandler(
-                        handle_accepted_name,
-                        pattern='name_accepted'
-                    ),
-                    CallbackQueryHandler(
-                        handle_rejected_user_name,
-                        pattern='name_rejected'
-                    ),
-                ],
-                State.NAME_REQUESTED: [
-                    MessageHandler(
-                        Filters.text,
-                        handle_new_name
-                    )
-                ],
-                State.EMAIL_REQUESTED: [
-                    MessageHandler(
-                        Filters.text,
-                        handle_email
-                    )
-                ],
-                State.PHONE_NUMBER_REQUESTED: [
-                    MessageHandler(
-                        Filters.text,
-                        handle_phone_number_text
-                    ),
-                    MessageHandler(
-                        Filters.contact,
-                        handle_contact
-                    ),
-                ],
-                State.ORDER_REGISTERED: [
-                    CallbackQueryHandler(
-                        send_products
-                    )
-                ],
-            },
-            fallbacks=[
-                CommandHandler('start', start)
-            ]
+        update_queue = BoundedUpdateQueue(maxsize=env.int('UPDATE_QUEUE_SIZE', 100))
+        persistence = None
+        if env.bool('REDIS_PERSISTENCE', False):
+            persistence = RedisPersistence(
+                redis_client,
+                State,
+                flush_interval=env.float('PERSISTENCE_FLUSH_INTERVAL', 0.2),
+            )
+        dispatcher = BoundedDispatcher(
+            bot,
+            update_queue,
+            workers=workers,
+            persistence=persistence,
+            use_context=True
         )
-
-        dispatcher.add_handler(conversation_handler)
-        dispatcher.add_error_handler(error_handler)
+        dispatcher.bot_data['update_queue'] = update_queue
+        updater = Updater(dispatcher=dispatcher)
+        setup_dispatcher(env, dispatcher, redis_client, client_id, client_secret, admin_chat_id)
+
+        metrics_port = env.int('METRICS_PORT', None)
+        if metrics_port:
+            components = {
+                name: dispatcher.bot_data[name]
+                for name in (
+                    'token_manager',
+                    'price_index',
+                    'photo_cache',
+                    'cart_cache',
+                    'customers',
+                    'inventory',
+                    'stock_poller',
+                    'orders',
+                    'update_queue',
+                )
+            }
+            components['dispatcher'] = dispatcher
+            components['outbound'] = bot.scheduler
+            components['moltin_client'] = api_policy
+            if persistence is not None:
+                components['persistence'] = persistence
+            start_metrics_server(metrics_port, components, address=env('METRICS_LISTEN', '127.0.0.1'))
+
+        webhook_url = env('WEBHOOK_URL', None)
+        if webhook_url:
+            updater.start_webhook(
+                listen=env('WEBHOOK_LISTEN', '0.0.0.0'),
+                port=env.int('WEBHOOK_PORT', 8443),
+                url_path=bot_token,
+                webhook_url=f'{webhook_url.rstrip("/")}/{bot_token}',
+                max_connections=env.int('WEBHOOK_MAX_CONNECTIONS', 40),
+            )
+        else:
+            updater.start_polling()
         logger.info('The bot started')
-        updater.start_polling()
         updater.idle()
     except HTTPError as http_error:
         logger.error(http_error.response.text)
@@ -0,0 +1,194 @@
+import asyncio
+import threading
+import time
+
+import fakeredis
+import pytest
+
+import moltin_async
+from inventory_ledger import InventoryLedger
+
+
+class TokenManager:
+
+    def get_access_token(self):
+        return 'token'
+
+
+@pytest.fixture
+def event_loop_thread():
+    event_loop = moltin_async.EventLoopThread()
+    event_loop.start()
+    yield event_loop
+    event_loop.stop()
+
+
+@pytest.fixture
+def ledger(event_loop_thread):
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    return InventoryLedger(redis_client, TokenManager(), event_loop_thread)
+
+
+def test_concurrent_reservations_never_oversell(ledger):
+    ledger.redis_client.hset(ledger.available_key, 'fish', 10)
+    results = []
+
+    def reserve():
+        results.append(ledger.reserve('fish', 1))
+
+    threads = [threading.Thread(target=reserve) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(True) == 10
+    assert ledger.redis_client.hget(ledger.available_key, 'fish') == '0'
+    assert ledger.redis_client.hget(ledger.pending_key, 'fish') == '10'
+
+
+def test_release_returns_stock(ledger):
+    ledger.redis_client.hset(ledger.available_key, 'fish', 5)
+
+    assert ledger.reserve('fish', 5)
+    assert not ledger.reserve('fish', 1)
+    ledger.release('fish', 5)
+
+    assert ledger.redis_client.hget(ledger.available_key, 'fish') == '5'
+    assert ledger.redis_client.hget(ledger.pending_key, 'fish') == '0'
+
+
+def test_failed_transaction_goes_back_to_pending(ledger, monkeypatch):
+    sent = []
+
+    async def update_product_quantity(access_token, product_id, quantity, action):
+        if product_id == 'salmon':
+            raise ConnectionError('elasticpath is down')
+        sent.append((product_id, quantity, action))
+
+    monkeypatch.setattr(moltin_async, 'update_product_quantity', update_product_quantity)
+    ledger.redis_client.hset(ledger.available_key, mapping={'fish': 10, 'salmon': 10})
+    ledger.reserve('fish', 3)
+    ledger.reserve('salmon', 4)
+
+    ledger.flush()
+
+    assert sent == [('fish', 3, 'allocate')]
+    assert ledger.redis_client.hgetall(ledger.pending_key) == {'salmon': '4'}
+    assert not ledger.redis_client.exists(ledger.in_flight_key)
+
+
+def test_load_during_flush_keeps_taken_reservations(ledger, monkeypatch):
+    async def get_product_quantity(access_token, product_id):
+        # Elasticpath has not received the allocation yet
+        return 10
+
+    monkeypatch.setattr(moltin_async, 'get_product_quantity', get_product_quantity)
+    ledger.redis_client.hset(ledger.available_key, 'fish', 10)
+    ledger.reserve('fish', 3)
+    ledger._take_pending(keys=[ledger.pending_key, ledger.in_flight_key])
+
+    assert ledger.load('fish') == 7
+
+
+def test_load_read_before_flush_does_not_overwrite_it(ledger, monkeypatch):
+    remote = {'fish': 10}
+
+    async def update_product_quantity(access_token, product_id, quantity, action):
+        remote[product_id] -= quantity
+
+    async def get_product_quantity(access_token, product_id):
+        quantity = remote[product_id]
+        # The flush goes through while the response is on its way
+        await asyncio.get_running_loop().run_in_executor(None, ledger.flush)
+        return quantity
+
+    monkeypatch.setattr(moltin_async, 'update_product_quantity', update_product_quantity)
+    monkeypatch.setattr(moltin_async, 'get_product_quantity', get_product_quantity)
+    ledger.redis_client.hset(ledger.available_key, 'fish', 10)
+    ledger.reserve('fish', 3)
+
+    assert ledger.load('fish') == 7
+    assert remote == {'fish': 7}
+    assert ledger.redis_client.hget(ledger.available_key, 'fish') == '7'
+
+
+def test_failed_load_keeps_stale_snapshot_unstamped(ledger, monkeypatch):
+    async def get_product_quantity(access_token, product_id):
+        raise ConnectionError('elasticpath is down')
+
+    monkeypatch.setattr(moltin_async, 'get_product_quantity', get_product_quantity)
+    ledger.redis_client.hset(ledger.available_key, 'fish', 8)
+    ledger.redis_client.hset(ledger.checked_at_key, 'fish', 0)
+
+    assert ledger.get_available('fish') == 8
+    assert ledger.redis_client.hget(ledger.checked_at_key, 'fish') == '0'
+
+
+def test_aborted_flush_keeps_reservations(ledger, monkeypatch):
+    sent = []
+
+    async def update_product_quantity(access_token, product_id, quantity, action):
+        sent.append((product_id, quantity, action))
+
+    class FailingTokenManager:
+
+        def get_access_token(self):
+            raise ConnectionError('elasticpath is down')
+
+    monkeypatch.setattr(moltin_async, 'update_product_quantity', update_product_quantity)
+    ledger.redis_client.hset(ledger.available_key, 'fish', 10)
+    ledger.reserve('fish', 3)
+    ledger.token_manager = FailingTokenManager()
+    with pytest.raises(ConnectionError):
+        ledger.flush()
+    assert ledger.redis_client.hgetall(ledger.pending_key) == {'fish': '3'}
+
+    ledger.token_manager = TokenManager()
+    ledger.reserve('fish', 2)
+    ledger.flush()
+
+    assert sent == [('fish', 5, 'allocate')]
+    assert not ledger.redis_client.exists(ledger.pending_key)
+    assert not ledger.redis_client.exists(ledger.in_flight_key)
+
+
+def test_changes_left_in_flight_go_out_with_next_flush(ledger, monkeypatch):
+    sent = []
+
+    async def update_product_quantity(access_token, product_id, quantity, action):
+        sent.append((product_id, quantity, action))
+
+    monkeypatch.setattr(moltin_async, 'update_product_quantity', update_product_quantity)
+    ledger.redis_client.hset(ledger.available_key, 'fish', 10)
+    ledger.reserve('fish', 3)
+    # The process died after taking the changes
+    ledger._take_pending(keys=[ledger.pending_key, ledger.in_flight_key])
+    ledger.reserve('fish', 1)
+
+    ledger.flush()
+
+    assert sent == [('fish', 4, 'allocate')]
+    assert not ledger.redis_client.exists(ledger.in_flight_key)
+
+
+def test_stock_read_by_the_caller_is_stored(ledger):
+    ledger.redis_client.hset(ledger.available_key, 'fish', 8)
+    ledger.redis_client.hset(ledger.checked_at_key, 'fish', 0)
+
+    snapshot, is_fresh = ledger.read_snapshot('fish')
+    generation = ledger.get_generation()
+    assert (snapshot, is_fresh) == (8, False)
+    assert ledger.store_load('fish', snapshot, ConnectionError('elasticpath is down'), generation) == 8
+
+    ledger.reserve('fish', 2)
+    assert ledger.store_load('fish', snapshot, 10, generation) == 8
+    assert ledger.read_snapshot('fish') == (8, True)
+
+
+def test_max_age_bounds_only_recently_viewed_products(ledger):
+    ledger.redis_client.hset(ledger.available_key, 'fish', 8)
+    ledger.redis_client.hset(ledger.checked_at_key, 'fish', time.time() - 60)
+
+    assert ledger.read_snapshot('fish') == (8, True)
+    assert ledger.read_snapshot('fish') == (8, False)
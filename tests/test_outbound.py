@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from outbound import DELETE_PRIORITY, SEND_PRIORITY, OutboundScheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = OutboundScheduler(global_rate=100, chat_rate=5, chat_burst=1, workers=4)
+    yield scheduler
+    scheduler.stop()
+
+
+def recorder(calls, name):
+    def call():
+        calls.append(name)
+        return name
+    return call
+
+
+def test_delete_waits_for_rate_limited_reply(scheduler):
+    calls = []
+    scheduler.submit(SEND_PRIORITY, 1, recorder(calls, 'first reply'))
+    reply = scheduler.submit(SEND_PRIORITY, 1, recorder(calls, 'second reply'), wait=False)
+    deletion = scheduler.submit(DELETE_PRIORITY, 1, recorder(calls, 'delete'), wait=False)
+
+    reply.result(timeout=5)
+    deletion.result(timeout=5)
+
+    assert calls == ['first reply', 'second reply', 'delete']
+
+
+def test_delete_waits_for_reply_retried_after_429(scheduler):
+    calls = []
+    attempts = []
+
+    def reply():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryAfter(0.3)
+        calls.append('reply')
+        return 'reply'
+
+    reply_future = scheduler.submit(SEND_PRIORITY, 1, reply, wait=False)
+    while not attempts:
+        time.sleep(0.01)
+    deletion = scheduler.submit(DELETE_PRIORITY, 1, recorder(calls, 'delete'), wait=False)
+
+    assert reply_future.result(timeout=5) == 'reply'
+    deletion.result(timeout=5)
+    assert calls == ['reply', 'delete']
+    assert scheduler.stats()['retried'] == 1
+
+
+def test_calls_of_one_chat_never_run_concurrently(scheduler):
+    running = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            if running:
+                overlaps.append(True)
+            running.append(True)
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+
+    futures = [scheduler.submit(DELETE_PRIORITY, 1, call, wait=False) for _ in range(10)]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert not overlaps
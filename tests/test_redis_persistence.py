@@ -0,0 +1,103 @@
+from enum import Enum
+
+import fakeredis
+import pytest
+from telegram.ext.utils.promise import Promise
+
+from redis_persistence import RedisPersistence
+
+
+class State(Enum):
+    PRODUCTS_SENT = 1
+    PRODUCT_HANDLED = 2
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture
+def persistence(redis_client):
+    persistence = RedisPersistence(redis_client, State, flush_interval=60)
+    yield persistence
+    persistence.stop()
+
+
+def test_flush_round_trip(redis_client, persistence):
+    persistence.update_user_data(1, {'product': 'cart-item'})
+    persistence.update_conversation('shop', (1, 1), State.PRODUCT_HANDLED)
+    persistence.update_bot_data({'orders': 3, 'service': object()})
+    persistence.flush()
+
+    other_instance = RedisPersistence(redis_client, State, flush_interval=60)
+    user_data = {}
+    other_instance.refresh_user_data(1, user_data)
+    assert user_data == {'product': 'cart-item'}
+    assert other_instance.read_conversation('shop', (1, 1)) == State.PRODUCT_HANDLED
+    assert other_instance.get_bot_data() == {'orders': 3}
+    other_instance.stop()
+
+
+def test_pending_writes_are_visible_before_flush(persistence):
+    persistence.update_user_data(1, {'product': 'cart-item'})
+    persistence.update_conversation('shop', (1, 1), State.PRODUCTS_SENT)
+
+    user_data = {}
+    persistence.refresh_user_data(1, user_data)
+    assert user_data == {'product': 'cart-item'}
+    assert persistence.read_conversation('shop', (1, 1)) == State.PRODUCTS_SENT
+
+
+def test_ended_conversation_is_removed(redis_client, persistence):
+    persistence.update_conversation('shop', (1, 1), State.PRODUCTS_SENT)
+    persistence.flush()
+    persistence.update_conversation('shop', (1, 1), None)
+    persistence.flush()
+
+    assert persistence.read_conversation('shop', (1, 1)) is None
+    assert not redis_client.hlen(persistence.conversations_key('shop'))
+
+
+def test_failed_flush_keeps_writes(redis_client, persistence, monkeypatch):
+    persistence.update_user_data(1, {'product': 'cart-item'})
+
+    def fail(*args):
+        raise ConnectionError('redis is down')
+
+    monkeypatch.setattr(persistence, '_write', fail)
+    with pytest.raises(ConnectionError):
+        persistence.flush()
+    monkeypatch.undo()
+    persistence.flush()
+
+    assert redis_client.hget(persistence.user_data_key, 1) == '{"product": "cart-item"}'
+
+
+def test_only_pending_promises_stay_in_memory(persistence):
+    conversations = persistence.get_conversations('shop')
+    conversations[(1, 1)] = State.PRODUCTS_SENT
+    assert not conversations.local_states
+
+    promise = Promise(lambda: State.PRODUCT_HANDLED, (), {})
+    pending_state = (State.PRODUCTS_SENT, promise)
+    conversations[(1, 1)] = pending_state
+    persistence.update_conversation('shop', (1, 1), pending_state)
+    assert conversations[(1, 1)] is pending_state
+
+    promise.run()
+
+    assert not conversations.local_states
+    assert conversations[(1, 1)] == State.PRODUCT_HANDLED
+
+
+def test_finished_promise_state_is_resolved(persistence):
+    conversations = persistence.get_conversations('shop')
+    promise = Promise(lambda: State.PRODUCT_HANDLED, (), {})
+    promise.run()
+
+    conversations[(1, 1)] = (State.PRODUCTS_SENT, promise)
+    persistence.update_conversation('shop', (1, 1), (State.PRODUCTS_SENT, promise))
+
+    assert not conversations.local_states
+    assert conversations[(1, 1)] == State.PRODUCT_HANDLED
@@ -0,0 +1,16 @@
+from resilience import ResiliencePolicy
+
+
+def no_status(error):
+    return None
+
+
+def test_stale_copies_are_bounded_by_size():
+    policy = ResiliencePolicy(stale_max_bytes=10)
+    policy.call('GET', '/images/first', lambda timeout: b'12345', no_status)
+    policy.call('GET', '/images/second', lambda timeout: b'123456', no_status)
+    policy.call('GET', '/images/huge', lambda timeout: b'12345678901', no_status)
+
+    assert policy.stats()['stale_entries'] == 1
+    assert policy.stats()['stale_bytes'] == 6
+    assert policy._stale_or_raise(('/images/second', ()), LookupError()) == b'123456'